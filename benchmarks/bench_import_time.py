@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Measures CLI startup time and which imports it spends it on.
+
+    python3 benchmarks/bench_import_time.py --max-ms 300
+
+Runs `download.py --help` in fresh interpreters and reports the median wall
+time together with the slowest modules from `python -X importtime`. Exits
+with status 1 if the median exceeds --max-ms or if any of the heavy
+dependencies (pandas, numpy, requests, keyring, boto3) is imported, so it
+can be used to catch startup regressions in CI.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+from timeit import default_timer
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ('pandas', 'numpy', 'requests', 'keyring', 'boto3', 'botocore')
+
+
+def run_once(command):
+    start = default_timer()
+    subprocess.run(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    return default_timer() - start
+
+
+def import_times(command):
+    """ :return: list of (cumulative microseconds, module) from -X importtime """
+    result = subprocess.run([command[0], '-X', 'importtime'] + command[1:], cwd=HERE,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line.split('|')
+        times.append((int(cumulative), module.strip()))
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='Number of interpreter starts to time')
+    parser.add_argument('--max-ms', type=float, default=None, help='Fail if the median startup time exceeds this')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to list')
+    args = parser.parse_args()
+
+    command = [sys.executable, 'download.py', '--help']
+    median = statistics.median(run_once(command) for _ in range(args.runs)) * 1000
+    times = import_times(command)
+    print('download.py --help: median {:.1f} ms over {} runs'.format(median, args.runs))
+    print('Slowest imports (cumulative):')
+    for cumulative, module in sorted(times, reverse=True)[:args.top]:
+        print('  {:>8.1f} ms  {}'.format(cumulative / 1000, module))
+
+    failed = False
+    heavy = sorted({m.split('.')[0] for _, m in times} & set(HEAVY_MODULES))
+    if heavy:
+        print('Heavy modules imported on the --help path: {}'.format(', '.join(heavy)))
+        failed = True
+    if args.max_ms is not None and median > args.max_ms:
+        print('Startup time {:.1f} ms exceeds the limit of {:.1f} ms'.format(median, args.max_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
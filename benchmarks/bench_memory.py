@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Measures the peak memory of a download run over a large manifest.
+
+    python3 benchmarks/bench_memory.py --files 200000
+
+Writes a synthetic datastructure manifest with --files rows (--per-subject
+files per subject), serves the NDA package API (/files lookups and
+presigned URLs) and the S3 objects of --size bytes from a local HTTP server
+in this process, and runs a real Downloader over the manifest in a fresh
+interpreter. Its peak RSS is reported above the RSS of an interpreter that
+only imported the Downloader and pandas, so it includes everything a run
+keeps: the selected S3 links and subsets of every package for the whole
+run, the package file records and presigned URLs of the files in flight,
+progress totals, and the pandas manifest while it is read. The files are
+written below --dir and removed afterwards.
+"""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from timeit import default_timer
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SUBSET = 'derivatives.func.task-rest_bold'
+ALIAS = 'derivatives/abcd-hcp-pipeline/sub-NDARINV{:08d}/ses-baselineYear1Arm1/func/' \
+        'sub-NDARINV{:08d}_ses-baselineYear1Arm1_task-rest_run-{}_bold.nii.gz'
+S3_PREFIX = 's3://NDAR_Central_1/submission_12345/'
+ID_RE = re.compile(r'sub-NDARINV(\d+)_ses-baselineYear1Arm1_task-rest_run-(\d+)_bold')
+
+WORKER = r'''
+import resource, sys
+sys.path.insert(0, {here!r})
+import pandas
+from src.Downloader import Downloader
+completed = 0
+if {manifest!r}:
+    downloader = Downloader.from_options({manifest!r}, {output!r}, package='1234567', auth=('user', 'password'),
+                                         basenames_file={basenames!r}, workerThreads={threads},
+                                         status_interval=3600)
+    downloader.package_url = {package_url!r}
+    completed = sum(record.status == 'completed' for record in downloader.iter_completed())
+print(completed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+
+class PackageHandler(BaseHTTPRequestHandler):
+    """ The package API and S3 of a package whose file IDs and sizes follow from the S3 links """
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.path.endswith('/files'):
+            files = []
+            for link in request:
+                subject, run = ID_RE.search(link).groups()
+                files.append({'package_file_id': int(subject) * 100 + int(run),
+                              'download_alias': link[len(S3_PREFIX):], 'file_size': self.server.size})
+            self.reply(json.dumps(files).encode())
+        elif self.path.endswith('/batchGeneratePresignedUrls'):
+            self.reply(json.dumps({'presignedUrls': [
+                {'package_file_id': i, 'downloadURL': self.presigned_url(i)} for i in request]}).encode())
+        else:
+            self.reply(json.dumps({'downloadURL': self.presigned_url(request[0])}).encode())
+
+    def presigned_url(self, package_file_id):
+        return 'http://127.0.0.1:{}/s3/{}?X-Amz-Algorithm=AWS4-HMAC-SHA256&X-Amz-Expires=86400' \
+               '&X-Amz-Signature={:064x}'.format(self.server.server_port, package_file_id, package_file_id)
+
+    def do_GET(self):
+        self.reply(self.server.body, 'application/octet-stream')
+
+
+def write_manifest(path, files, per_subject):
+    with open(path, 'w') as f:
+        f.write('manifest_name\tassociated_file\n')
+        for i in range(files):
+            subject, run = divmod(i, per_subject)
+            f.write('sub-NDARINV{:08d}.{}.manifest.json\t{}{}\n'.format(
+                subject, SUBSET, S3_PREFIX, ALIAS.format(subject, subject, run + 1)))
+
+
+def peak_rss(**options):
+    """ :return: files completed and peak resident set size of the worker in kilobytes """
+    result = subprocess.run([sys.executable, '-c', WORKER.format(here=HERE, **options)],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, check=True)
+    completed, rss = result.stdout.split()[-2:]
+    return int(completed), int(rss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=200000, help='Number of manifest rows, all selected')
+    parser.add_argument('--per-subject', type=int, default=50, help='Files per subject')
+    parser.add_argument('--size', type=int, default=16, help='Object size in bytes')
+    parser.add_argument('--threads', type=int, default=32, help='Download threads')
+    parser.add_argument('--dir', default=tempfile.gettempdir(), help='Directory the downloads are written to')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), PackageHandler)
+    server.daemon_threads = True
+    server.size = args.size
+    server.body = os.urandom(args.size)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    root = tempfile.mkdtemp(dir=args.dir)
+    try:
+        manifest = os.path.join(root, 'datastructure_manifest.txt')
+        basenames = os.path.join(root, 'subsets.txt')
+        write_manifest(manifest, args.files, args.per_subject)
+        with open(basenames, 'w') as f:
+            f.write(SUBSET + '\n')
+        options = dict(output=os.path.join(root, 'output'), basenames=basenames, threads=args.threads,
+                       package_url='http://127.0.0.1:{}/api/package'.format(server.server_port))
+        _, baseline = peak_rss(manifest=None, **options)
+        start = default_timer()
+        completed, run = peak_rss(manifest=manifest, **options)
+        elapsed = default_timer() - start
+    finally:
+        shutil.rmtree(root)
+
+    downloaded = run - baseline
+    print('Downloaded {} of {} files in {:.1f}s'.format(completed, args.files, elapsed))
+    print('Peak RSS {:.1f} MB, {:.1f} MB above the imports, {:.1f} MB per 1M files'.format(
+        run / 1024, downloaded / 1024, downloaded / 1024 * 1000000 / args.files))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Measures how download throughput scales with the number of worker processes.
+
+    python3 benchmarks/bench_processes.py --processes 1 2 4 8 --files 64 --size 64
+
+Serves --files objects of --size MB from a local HTTP server (run in several
+processes sharing one port, so the server is not the bottleneck) and
+downloads them with src/WorkerProcesses.py for every process count, with
+--threads threads per process and sha256 checksums to make the per-byte work
+CPU-bound like TLS decryption is on a real S3 download. Reports the
+throughput of every run and its speedup over the first process count.
+Downloads are written below --dir and removed after every run. The workers
+log every file to stderr, redirect it to keep the table readable.
+"""
+
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.FileStore import PackageFile
+from src.WorkerProcesses import WorkerProcesses
+
+
+class ObjectHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = self.server.body
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ReusePortServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        ThreadingHTTPServer.server_bind(self)
+
+
+def serve(port, size, ready):
+    server = ReusePortServer(('127.0.0.1', port), ObjectHandler)
+    server.body = memoryview(os.urandom(size))
+    ready.set()
+    server.serve_forever()
+
+
+def start_servers(count, size):
+    """ :return: port of ``count`` server processes listening on the same port """
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    context = get_context('spawn')
+    for _ in range(count):
+        ready = context.Event()
+        context.Process(target=serve, args=(port, size, ready), daemon=True).start()
+        ready.wait()
+    return port
+
+
+def run(processes, threads, port, files, size, root):
+    output = tempfile.mkdtemp(dir=root)
+    args = argparse.Namespace(output=output, workerThreads=threads, checksum='sha256', package=None,
+                              manifest_file=None, basenames_file=None, subject_list_file=None)
+    failed = []
+
+    def report(record, package_file):
+        if record.status != 'completed':
+            failed.append(record)
+
+    workers = WorkerProcesses(args, processes, report)
+    start = default_timer()
+    workers.submit([(PackageFile(i, 1, 'sub-{:04d}/file.bin'.format(i), size),
+                     'http://127.0.0.1:{}/obj/{}'.format(port, i)) for i in range(files)])
+    workers.close()
+    elapsed = default_timer() - start
+    shutil.rmtree(output)
+    if failed:
+        raise RuntimeError('{} downloads failed: {}'.format(len(failed), failed[0].error))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4], help='Worker process counts to compare')
+    parser.add_argument('--threads', type=int, default=4, help='Threads per worker process')
+    parser.add_argument('--files', type=int, default=64, help='Number of objects to download per run')
+    parser.add_argument('--size', type=int, default=64, help='Object size in MB')
+    parser.add_argument('--servers', type=int, default=os.cpu_count(), help='Number of server processes')
+    parser.add_argument('--dir', default=tempfile.gettempdir(), help='Directory the downloads are written to')
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    port = start_servers(args.servers, size)
+    total = args.files * size
+    baseline = None
+    print('{:>10} {:>10} {:>12} {:>10}'.format('processes', 'seconds', 'MB/s', 'speedup'))
+    for processes in args.processes:
+        elapsed = run(processes, args.threads, port, args.files, size, args.dir)
+        rate = total / elapsed
+        baseline = baseline or rate
+        print('{:>10} {:>10.2f} {:>12.1f} {:>9.2f}x'.format(processes, elapsed, rate / 1024 ** 2, rate / baseline))
+
+
+if __name__ == '__main__':
+    main()
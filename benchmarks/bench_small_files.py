@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Measures the small-file fast path against the streaming path and the
+original download loop.
+
+    python3 benchmarks/bench_small_files.py --files 2000 --size 4 --latency 20
+
+Serves --files objects of --size KB from a local keep-alive HTTP server in a
+separate process and downloads them into a fresh directory below --dir three
+times: with the original loop (a new requests session, so a new connection,
+per file, streamed through a .partial file and renamed), with
+--small-file-size 0 (every file streamed through a .partial file and renamed
+on the thread's kept-alive session) and with the default fast path (received
+in memory, written with one call, logged in batches). Reports files per
+second for each run and the speedup over the original loop.
+
+--latency delays every response by that many milliseconds, and every new
+connection by three times as many for the TCP and TLS handshakes, which is
+roughly what a download from S3 pays per round trip. Without it the server
+answers at loopback speed and the runs mostly measure the CPU time per file.
+The streaming runs log every file to stderr, redirect it to keep the table
+readable.
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.Downloader import Downloader, ThreadPool, logger
+from src.FileStore import PackageFile
+
+
+class Failures(list):
+    """ Stands in for the Downloader's completion queue, keeping the failed records """
+
+    def put(self, record):
+        if record.status != 'completed':
+            self.append(record)
+
+
+class ObjectHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, with Nagle's algorithm every
+    # response on a kept-alive connection would wait for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        # TCP and TLS handshakes of a new connection
+        time.sleep(3 * self.server.latency)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        body = self.server.body
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(size, latency, ports):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ObjectHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 128
+    server.body = os.urandom(size)
+    server.latency = latency
+    ports.put(server.server_port)
+    server.serve_forever()
+
+
+def start_server(size, latency):
+    """ :return: port of a server process answering every GET with ``size`` bytes after ``latency`` seconds """
+    ports = multiprocessing.Queue()
+    multiprocessing.Process(target=serve, args=(size, latency, ports), daemon=True).start()
+    return ports.get()
+
+
+def original_download(url, path):
+    """ The download loop before the fast path: a session per file and a .partial file renamed once complete """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    partial = path + '.partial'
+    logger.info('Starting download: {}'.format(partial))
+    with requests.session() as s:
+        s.mount(url, HTTPAdapter(max_retries=10))
+        with open(partial, 'wb') as download_file:
+            with s.get(url, stream=True) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=1024 * 1024 * 5):
+                    if chunk:
+                        download_file.write(chunk)
+    os.rename(partial, path)
+    logger.info('Completed download: {}'.format(path))
+
+
+def run_original(threads, port, files, root):
+    output = tempfile.mkdtemp(dir=root)
+    pool = ThreadPool(threads)
+    start = default_timer()
+    for i in range(files):
+        path = os.path.join(output, 'sub-{:04d}/file-{}.json'.format(i // 100, i))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pool.add_task(original_download, 'http://127.0.0.1:{}/obj/{}'.format(port, i), path)
+    pool.wait_completion()
+    elapsed = default_timer() - start
+    shutil.rmtree(output)
+    return elapsed
+
+
+def run(small_file_size, threads, port, files, size, root):
+    output = tempfile.mkdtemp(dir=root)
+    args = argparse.Namespace(output=output, workerThreads=threads, checksum=None, package=None,
+                              manifest_file=None, basenames_file=None, subject_list_file=None,
+                              small_file_size=small_file_size)
+    downloader = Downloader(args, autostart=False, select=False)
+    downloader.completed = failed = Failures()
+    pool = ThreadPool(threads)
+    start = default_timer()
+    for i in range(files):
+        package_file = PackageFile(i, 1, 'sub-{:04d}/file-{}.json'.format(i // 100, i), size)
+        os.makedirs(os.path.join(output, os.path.dirname(package_file.alias)), exist_ok=True)
+        downloader.files.put(package_file, 'http://127.0.0.1:{}/obj/{}'.format(port, i))
+        pool.add_task(downloader.download_from_url, package_file)
+    pool.wait_completion()
+    downloader.small_file_log.flush()
+    downloader.sink.close()
+    elapsed = default_timer() - start
+    shutil.rmtree(output)
+    if failed:
+        raise RuntimeError('{} downloads failed: {}'.format(len(failed), failed[0].error))
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=2000, help='Number of objects to download per run')
+    parser.add_argument('--size', type=int, default=4, help='Object size in KB')
+    parser.add_argument('--threads', type=int, default=8, help='Download threads')
+    parser.add_argument('--latency', type=float, default=0, help='Round trip time to simulate in milliseconds')
+    parser.add_argument('--dir', default=tempfile.gettempdir(), help='Directory the downloads are written to')
+    args = parser.parse_args()
+
+    size = args.size * 1024
+    port = start_server(size, args.latency / 1000)
+    print('{:>12} {:>10} {:>12} {:>10}'.format('path', 'seconds', 'files/s', 'speedup'))
+    original = run_original(args.threads, port, args.files, args.dir)
+    print('{:>12} {:>10.2f} {:>12.1f} {:>10}'.format('original', original, args.files / original, '1.00x'))
+    for name, small_file_size in (('streaming', 0), ('fast path', None)):
+        elapsed = run(small_file_size, args.threads, port, args.files, size, args.dir)
+        print('{:>12} {:>10.2f} {:>12.1f} {:>9.2f}x'.format(name, elapsed, args.files / elapsed, original / elapsed))
+
+if __name__ == '__main__':
+    main()
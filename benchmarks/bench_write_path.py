@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Measures local write throughput of the download write path for every
+durability policy, with and without preallocation.
+
+    python3 benchmarks/bench_write_path.py --dir /scratch/$USER/bench --files 200 --size 16
+
+Run it on the filesystem you download to; numbers from a laptop SSD say
+little about GPFS or Lustre.
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from timeit import default_timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.Buffers import BufferPool, read_chunks
+from src.Sinks import LocalFileSink, DURABILITY_POLICIES, get_stripe_size, align_buffer_size
+
+
+class ZeroStream:
+    """ Stand-in for response.raw that produces ``size`` bytes """
+
+    def __init__(self, size):
+        self.remaining = size
+
+    def readinto(self, b):
+        n = min(len(b), self.remaining)
+        self.remaining -= n
+        return n
+
+
+def run(directory, policy, preallocate, files, size, buffers):
+    root = tempfile.mkdtemp(dir=directory)
+    sink = LocalFileSink(root, durability=policy, preallocate=preallocate)
+    view = buffers.get()
+    start = default_timer()
+    for i in range(files):
+        writer = sink.open('sub-{:04d}/ses-1/file.nii.gz'.format(i), size)
+        for chunk in read_chunks(ZeroStream(size), view):
+            writer.write(chunk)
+        writer.commit()
+    sink.close()
+    elapsed = default_timer() - start
+    shutil.rmtree(root)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default=tempfile.gettempdir(), help='Directory on the filesystem to test')
+    parser.add_argument('--files', type=int, default=100, help='Number of files per run')
+    parser.add_argument('--size', type=int, default=8, help='Size of each file in MB')
+    parser.add_argument('--buffer-size', type=int, default=5, help='Chunk buffer size in MB')
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    stripe_size = get_stripe_size(args.dir)
+    buffers = BufferPool(align_buffer_size(args.buffer_size * 1024 * 1024, stripe_size))
+    print('{} files of {}MB in {}, stripe size {}KB, buffer {}KB'.format(
+        args.files, args.size, args.dir, stripe_size // 1024, buffers.buffer_size // 1024))
+    print('{:<10} {:<12} {:>10} {:>10}'.format('policy', 'preallocate', 'MB/s', 'files/s'))
+    for policy in DURABILITY_POLICIES:
+        for preallocate in (False, True):
+            elapsed = run(args.dir, policy, preallocate, args.files, size, buffers)
+            print('{:<10} {:<12} {:>10.1f} {:>10.1f}'.format(
+                policy, str(preallocate), args.files * args.size / elapsed, args.files / elapsed))
+
+
+if __name__ == '__main__':
+    main()
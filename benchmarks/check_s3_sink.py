@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+Checks the S3 output sink against an object store: single request and
+multipart uploads, aborted uploads, and skipping objects that are already
+present.
+
+Without --endpoint-url the checks run against an in-memory S3 mocked by moto
+(pip install 'moto[s3]'):
+
+    python3 benchmarks/check_s3_sink.py
+
+or against a real S3-compatible store, e.g. a local MinIO server, in a bucket
+that must exist and will receive a few test objects under --prefix:
+
+    python3 benchmarks/check_s3_sink.py --endpoint-url http://localhost:9000 --bucket test
+
+Every check prints ok or FAILED, the exit status is 1 if any failed.
+"""
+
+import argparse
+import hashlib
+import os
+import sys
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.Buffers import BufferPool, read_chunks
+from src.Sinks import S3Sink, MIN_PART_SIZE
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class RandomStream:
+    """ Stand-in for response.raw that produces ``size`` reproducible bytes """
+
+    def __init__(self, size, seed=0):
+        self.data = (hashlib.sha256(str(seed).encode()).digest() * (size // 32 + 1))[:size]
+        self.position = 0
+
+    def readinto(self, b):
+        n = min(len(b), len(self.data) - self.position)
+        b[:n] = self.data[self.position:self.position + n]
+        self.position += n
+        return n
+
+
+def upload(sink, alias, size, seed, buffers, fail_after=None):
+    """ Streams ``size`` bytes into the sink like a download, aborting after ``fail_after`` bytes """
+    stream = RandomStream(size, seed)
+    writer = sink.open(alias, size)
+    for chunk in read_chunks(stream, buffers.get()):
+        writer.write(chunk)
+        if fail_after is not None and writer.size >= fail_after:
+            writer.abort()
+            return writer, stream.data
+    writer.commit()
+    return writer, stream.data
+
+
+def check(results, name, condition, detail=''):
+    results.append(condition)
+    print('{:<60} {}{}'.format(name, 'ok' if condition else 'FAILED', '' if condition else ' ' + detail))
+
+
+def pending_uploads(sink):
+    response = sink.client.list_multipart_uploads(Bucket=sink.bucket, Prefix=sink.prefix)
+    return response.get('Uploads', [])
+
+
+def run_checks(sink):
+    results = []
+    buffers = BufferPool(CHUNK_SIZE)
+    client = sink.client
+
+    # Smaller than a part: one put_object request
+    alias = 'sub-0001/ses-1/anat/small.nii.gz'
+    writer, data = upload(sink, alias, 100 * 1024, 1, buffers)
+    body = client.get_object(Bucket=sink.bucket, Key=sink.key(alias))['Body'].read()
+    check(results, 'small object uploaded in one request', body == data and writer.upload_id is None)
+
+    # Two full parts and a short last one
+    alias = 'sub-0001/ses-1/func/large.nii.gz'
+    size = 2 * sink.part_size + 1234
+    writer, data = upload(sink, alias, size, 2, buffers)
+    head = client.head_object(Bucket=sink.bucket, Key=sink.key(alias))
+    body = client.get_object(Bucket=sink.bucket, Key=sink.key(alias))['Body'].read()
+    check(results, 'multipart object has all its bytes', body == data, '{} of {} bytes'.format(len(body), size))
+    check(results, 'multipart object has three parts', head['ETag'].strip('"').endswith('-3'), head['ETag'])
+    check(results, 'multipart upload buffered at most one part', writer.upload_id is not None and not writer.buffer)
+    check(results, 'no multipart upload left open after commit', not pending_uploads(sink))
+
+    # Aborted after the first part was uploaded
+    alias = 'sub-0002/ses-1/func/aborted.nii.gz'
+    writer, _ = upload(sink, alias, 3 * sink.part_size, 3, buffers, fail_after=sink.part_size + CHUNK_SIZE)
+    check(results, 'aborted upload had started a multipart upload', writer.upload_id is not None)
+    check(results, 'aborted upload left no multipart upload', not pending_uploads(sink))
+    check(results, 'aborted upload left no object', not sink.contains(alias))
+
+    # What the download loop checks before transferring a file
+    check(results, 'present object with the same size is skipped',
+          sink.contains('sub-0001/ses-1/func/large.nii.gz', size))
+    check(results, 'present object with another size is downloaded again',
+          not sink.contains('sub-0001/ses-1/func/large.nii.gz', size + 1))
+    check(results, 'missing object is downloaded', not sink.contains('sub-0003/ses-1/func/missing.nii.gz', size))
+    return all(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoint-url', help='S3-compatible store to check, by default S3 mocked by moto')
+    parser.add_argument('--bucket', default='check-s3-sink', help='Bucket, created when mocked')
+    parser.add_argument('--prefix', default='check-s3-sink/{}'.format(uuid.uuid4().hex[:8]),
+                        help='Prefix of the test objects')
+    parser.add_argument('--part-size', type=int, default=MIN_PART_SIZE // (1024 * 1024),
+                        help='Multipart part size in MB, at least 5')
+    args = parser.parse_args()
+    url = 's3://{}/{}'.format(args.bucket, args.prefix)
+    part_size = args.part_size * 1024 * 1024
+
+    if args.endpoint_url:
+        sink = S3Sink(url, endpoint_url=args.endpoint_url, part_size=part_size)
+        ok = run_checks(sink)
+        objects = sink.client.list_objects_v2(Bucket=sink.bucket, Prefix=sink.prefix).get('Contents', [])
+        for obj in objects:
+            sink.client.delete_object(Bucket=sink.bucket, Key=obj['Key'])
+    else:
+        try:
+            from moto import mock_aws
+        except ImportError:
+            sys.exit("moto is not installed, run pip install 'moto[s3]' or pass --endpoint-url")
+        # moto never sends these anywhere, they keep boto3 from looking for real credentials
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        with mock_aws():
+            sink = S3Sink(url, part_size=part_size)
+            sink.client.create_bucket(Bucket=args.bucket)
+            ok = run_checks(sink)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
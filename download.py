@@ -15,8 +15,6 @@ import sys
 import argparse
 import logging
 
-from src.Downloader import *
-
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
@@ -27,25 +25,33 @@ logger.addHandler(ch)
 HOME = os.path.expanduser("~")
 HERE = os.path.dirname(os.path.abspath(sys.argv[0]))
 
-def generate_parser():
+COMMANDS = ('export-plan', 'import-completed', 'serve-cache', 'status')
+
+def generate_parser(command=None):
+    """
+    :param command: None to download, or one of COMMANDS
+    """
 
     parser = argparse.ArgumentParser(
-        prog='download.py',
+        prog='download.py' if command is None else 'download.py ' + command,
         description=__doc__
     )
     parser.add_argument(
-        '-dp', '--package', metavar='<package-id>', type=str, action='store',
-        help='Flags to download all S3 files in package. Required.')
+        '-dp', '--package', metavar='<package-id>', type=str, nargs='+', action='store',
+        help=('Flags to download all S3 files in package. Required.  Several package IDs may be '
+              'given to download them in one run with a shared pool of workers.'))
     parser.add_argument(
-        "-m", "--manifest", dest="manifest_file", type=str, required=True,
+        "-m", "--manifest", dest="manifest_file", type=str, nargs='+', required=command != 'import-completed',
         help=("Path to the .csv file downloaded from the NDA containing s3 links "
-              "for all subjects and their derivatives.")
+              "for all subjects and their derivatives.  When several packages are given, "
+              "provide one manifest per package in the same order.")
     )
     parser.add_argument(
        "-o", "--output", dest="output", type=str, required=True,
         help=("Path to root folder which NDA data will be downloaded into.  "
               "A folder will be created at the given path if one does not "
-              "already exist.")
+              "already exist.  An s3://bucket/prefix URL uploads the data straight "
+              "to an S3-compatible object store instead, see --s3-endpoint-url.")
     )
     parser.add_argument(
         "-s", "--subject-list", dest="subject_list_file", type=str, required=False,
@@ -66,7 +72,18 @@ def generate_parser():
               "for each subject.  By default all the possible derivatives and inputs will be will "
               "be used.  This is the data_subsets.txt file included in this repository.  "
               "To select a subset it is recomended that you simply copy this file and remove all "
-              "the basenames that you do not want.")
+              "the basenames that you do not want.  Lines may also be glob patterns "
+              "(derivatives.func.*task-rest*) or regular expressions prefixed with re:.")
+    )
+    parser.add_argument(
+        "--sessions", dest="sessions", nargs='+', metavar='<session>', required=False,
+        help=("Only download data from these sessions, e.g. ses-baselineYear1Arm1.  Glob patterns "
+              "such as 'ses-*Year*' are accepted.  By default all sessions are selected.")
+    )
+    parser.add_argument(
+        "--explain", dest="explain", action="store_true",
+        help=("Print how many manifest rows each line of the basenames file selects and exit "
+              "without downloading anything.")
     )
     parser.add_argument(
         '-wt', '--workerThreads', metavar='<thread-count>', type=int, action='store',
@@ -75,14 +92,303 @@ def generate_parser():
     A default value is calculated based on the number of cpus found on the machine, however a higher value can be chosen to decrease download times. 
     If this value is set too high the download will slow. With 32 GB of RAM, a value of '10' is probably close to the maximum number of 
     parallel downloads that the computer can handle''')
+    parser.add_argument(
+        "--max-retries", dest="max_retries", type=int, required=False, default=7,
+        help=("Maximum number of retries of every NDA API request and file download after its first "
+              "attempt, 0 to not retry.  Server errors, timeouts and throttling are retried with "
+              "exponential backoff, other client errors are not retried.  Default: 7")
+    )
+    parser.add_argument(
+        "--retry-budget", dest="retry_budget", type=int, required=False, default=900,
+        help=("Maximum number of seconds spent waiting between retries of a single request or "
+              "download.  Default: 900")
+    )
+    parser.add_argument(
+        "--first-byte-timeout", dest="first_byte_timeout", type=int, required=False, default=60,
+        help=("Seconds to wait for the first byte of a file before the download is aborted and "
+              "retried.  Default: 60")
+    )
+    parser.add_argument(
+        "--idle-timeout", dest="idle_timeout", type=int, required=False, default=60,
+        help=("Seconds without receiving any data before a download is aborted and resumed from "
+              "the bytes already written.  Default: 60")
+    )
+    parser.add_argument(
+        "--min-throughput", dest="min_throughput", type=int, required=False, default=0,
+        help=("Minimum throughput in KB/s, averaged over two minutes, below which a download is "
+              "aborted and resumed on a new connection.  Default: 0 (disabled)")
+    )
+    parser.add_argument(
+        "--hedge", dest="hedge", action="store_true",
+        help=("Once every file has been handed to a worker, re-request downloads running at less "
+              "than a tenth of the median speed of the other downloads still in flight.")
+    )
+    parser.add_argument(
+        "--checksum", dest="checksum", choices=['md5', 'sha1', 'sha256'], required=False,
+        help=("Compute a checksum of every file while it downloads and log it with the "
+              "completed download.")
+    )
+    parser.add_argument(
+        "--verify-gzip", dest="verify_gzip", action='store_true',
+        help=("Decompress every .gz file while it downloads to check its gzip CRC and length.  "
+              "Corrupt or truncated files are downloaded again from the start.")
+    )
+    parser.add_argument(
+        "--check-nifti", dest="check_nifti", action='store_true',
+        help=("As --verify-gzip, and also check that every .nii.gz file starts with a valid "
+              "NIfTI-1 or NIfTI-2 header and holds all of its image data.")
+    )
+    parser.add_argument(
+        "--gunzip", dest="gunzip", action='store_true',
+        help=("As --verify-gzip, and also write an uncompressed copy next to every .gz file.  "
+              "Needs a plain output folder (no --bundle or s3:// output).")
+    )
+    parser.add_argument(
+        "--buffer-size", dest="buffer_size", type=int, required=False, default=5,
+        help=("Size in MB of the reusable chunk buffer each worker thread reads into.  Peak buffer "
+              "memory is roughly the number of worker threads times this value.  Default: 5")
+    )
+    parser.add_argument(
+        "--stripe-size", dest="stripe_size", type=int, required=False,
+        help=("Stripe (or block) size in KB of the output filesystem.  The chunk buffer is rounded "
+              "up to a multiple of it so writes are stripe aligned.  By default the block size "
+              "reported by the filesystem is used, on Lustre pass the value shown by `lfs getstripe`.")
+    )
+    parser.add_argument(
+        "--durability", dest="durability", choices=['none', 'fsync', 'fsync-dir'], default='none',
+        help=("When downloaded files are flushed to stable storage.  'none' leaves it to the OS "
+              "(fastest), 'fsync' fsyncs every file before renaming it from .partial and "
+              "'fsync-dir' additionally fsyncs the parent directories in batches so the renames "
+              "survive a node failure.  Default: none")
+    )
+    parser.add_argument(
+        "--min-free-space", dest="min_free_space", type=float, required=False, default=0,
+        help=("Space in GB to keep free on the output filesystem.  Every file reserves its size "
+              "before it is queued, and queueing pauses while the queued and in-flight files would "
+              "bring the free space below this watermark.  It resumes on its own when downloads "
+              "finish or space is freed.  Default: 0")
+    )
+    parser.add_argument(
+        "--disk-quota", dest="disk_quota", type=float, required=False,
+        help=("Quota headroom in GB left for the output folder, e.g. from `quota -s` or "
+              "`lfs quota`.  Downloads are admitted as with --min-free-space so the run "
+              "never writes more than this.")
+    )
+    parser.add_argument(
+        "--bundle", dest="bundle", choices=['subject', 'session'], required=False,
+        help=("Stream all files belonging to the same subject (or session) into a single "
+              "archive in the output folder instead of writing every file individually. "
+              "This greatly reduces the number of files (inodes) created on parallel filesystems. "
+              "Use src/Bundle.py's BundleReader to read single files back without extracting.")
+    )
+    parser.add_argument(
+        "--bundle-format", dest="bundle_format", choices=['tar', 'zip'], default='tar',
+        help=("Archive format used with --bundle.  Tar bundles are written with a sidecar .idx "
+              "offset index and can be resumed after an interruption.  Default: tar")
+    )
+    parser.add_argument(
+        "--s3-endpoint-url", dest="s3_endpoint_url", type=str, required=False,
+        help=("Endpoint of the S3-compatible object store (e.g. an on-prem MinIO at "
+              "http://minio.example.org:9000) used when --output is an s3:// URL.  "
+              "By default AWS S3 is used.  Credentials are read by boto3 from the usual "
+              "environment variables or ~/.aws/credentials.")
+    )
+    parser.add_argument(
+        "--small-file-size", dest="small_file_size", type=int, required=False, default=1024,
+        help=("Files up to this size in KB (e.g. JSON sidecars and TSVs) are received in memory "
+              "over reused connections and written with a single call, without a .partial file, "
+              "and logged in batches.  0 disables this.  Default: 1024")
+    )
+    parser.add_argument(
+        "--processes", dest="processes", type=int, required=False, default=1,
+        help=("Number of worker processes, each running its own pool of --workerThreads "
+              "threads.  On fast data-transfer nodes a single process is limited by the Python "
+              "GIL (TLS, checksums, chunk handling) long before the network is saturated.  "
+              "Default: 1")
+    )
+    parser.add_argument(
+        "--status-file", dest="status_file", type=str, required=False,
+        help=("File the progress of the run is saved to, read by `download.py status`.  "
+              "Default: .download-status.json in the output folder (none for s3:// output)")
+    )
+    parser.add_argument(
+        "--status-interval", dest="status_interval", type=int, required=False, default=60,
+        help="Seconds between progress log lines and saves of the status file.  Default: 60"
+    )
+    parser.add_argument(
+        "--cache-proxy", dest="cache_proxy", type=str, required=False, metavar='URL',
+        help=("Fetch files through a shared cache service started with `download.py serve-cache`, "
+              "e.g. http://cachehost:8642.  Files other users already downloaded are served "
+              "from the cache instead of S3.")
+    )
+    parser.add_argument(
+        "--profile", dest="profile", type=str, required=False, metavar='TRACE_FILE',
+        help=("Record how long every stage of the run takes (manifest parsing, /files lookups, "
+              "presigning, requests, transfers, writes) and write the spans to TRACE_FILE in "
+              "Chrome trace format, for chrome://tracing or https://ui.perfetto.dev.  A table of "
+              "the top time sinks is logged at the end.  Cheap enough to leave on.")
+    )
+    parser.add_argument(
+        "--profile-sample", dest="profile_sample", type=float, required=False, metavar='MS',
+        help=("With --profile, also sample the stacks of all threads every MS milliseconds "
+              "and write them next to the trace as a .folded file for flamegraph.pl or speedscope.")
+    )
+    if command is not None:
+        parser.add_argument(
+            "--plan-dir", dest="plan_dir", type=str, required=True,
+            help=("Folder receiving the exported plan segments and their index.jsonl "
+                  "(export-plan), or the folder of a previous export (import-completed).")
+        )
+    if command == 'export-plan':
+        parser.add_argument(
+            "--format", dest="plan_format", choices=['aria2', 'tsv', 'jsonl'], default='aria2',
+            help=("Format of the plan segments.  'aria2' is an aria2c --input-file, 'tsv' has "
+                  "one presigned URL and target path per line and 'jsonl' one JSON object "
+                  "per file.  Default: aria2")
+        )
+        parser.add_argument(
+            "--staging", dest="staging", type=str, required=False,
+            help=("Folder the external tool writes the files to.  By default the output "
+                  "folder itself, or <plan-dir>/staging for --bundle and s3:// outputs.")
+        )
+        parser.add_argument(
+            "--segment-minutes", dest="segment_minutes", type=int, required=False, default=60,
+            help=("Start a new plan segment every this many minutes, so every segment only "
+                  "holds presigned URLs created around the same time.  Default: 60")
+        )
+        parser.add_argument(
+            "--url-lifetime", dest="url_lifetime", type=float, required=False, default=24,
+            help=("Hours a presigned URL stays valid, used to name every segment after the "
+                  "time its URLs expire.  Default: 24")
+        )
+
+    return parser
+
+def generate_serve_cache_parser():
+
+    parser = argparse.ArgumentParser(
+        prog='download.py serve-cache',
+        description=("Runs a read-through cache for S3 objects that downloaders on the same "
+                     "cluster can share with --cache-proxy.  Every user still needs their own "
+                     "NDA credentials, the cache only serves objects to callers whose presigned "
+                     "URL S3 accepts.")
+    )
+    parser.add_argument(
+        "--cache-dir", dest="cache_dir", type=str, required=True,
+        help="Folder holding the cached objects."
+    )
+    parser.add_argument(
+        "--cache-size", dest="cache_size", type=float, required=True,
+        help=("Maximum size of the cache in GB.  The least recently used objects are "
+              "evicted when it is exceeded.")
+    )
+    parser.add_argument(
+        "--bind", dest="bind", type=str, default='127.0.0.1',
+        help=("Address to listen on.  Use 0.0.0.0 to serve other hosts of the cluster, "
+              "ideally behind a firewall.  Default: 127.0.0.1")
+    )
+    parser.add_argument(
+        "--allow-origin", dest="allow_origins", action='append', default=[], metavar='ORIGIN',
+        help=("Also fetch URLs on this origin, e.g. http://minio.example.org:9000.  By default "
+              "only https URLs of AWS S3 hosts are fetched.  Can be given several times.")
+    )
+    parser.add_argument(
+        "--port", dest="port", type=int, default=8642,
+        help="Port to listen on.  Default: 8642"
+    )
+
+    return parser
+
+def generate_status_parser():
+
+    parser = argparse.ArgumentParser(
+        prog='download.py status',
+        description=("Shows the progress of a download run from its status file: files and bytes "
+                     "done and remaining in total, per data subset and per subject, the current "
+                     "rate and the ETA.  Works from any process or node that can read the file.")
+    )
+    parser.add_argument(
+        "-o", "--output", dest="output", type=str, required=False,
+        help="Output folder of the run, its status file is .download-status.json in it."
+    )
+    parser.add_argument(
+        "--status-file", dest="status_file", type=str, required=False,
+        help="Status file of the run, if it was given with --status-file."
+    )
+    parser.add_argument(
+        "--top", dest="top", type=int, default=10,
+        help="Number of data subsets and incomplete subjects listed.  Default: 10"
+    )
+    parser.add_argument(
+        "--json", dest="json", action='store_true',
+        help="Print the status file as it is."
+    )
 
     return parser
 
 def main():
-    parser = generate_parser()
-    args = parser.parse_args()
+    command = sys.argv[1] if len(sys.argv) > 1 and sys.argv[1] in COMMANDS else None
+    if command == 'serve-cache':
+        args = generate_serve_cache_parser().parse_args(sys.argv[2:])
+        from src.CacheProxy import serve_cache
+        serve_cache(args.cache_dir, int(args.cache_size * 1024 ** 3), host=args.bind, port=args.port,
+                    allowed_origins=args.allow_origins)
+        return
+
+    if command == 'status':
+        parser = generate_status_parser()
+        args = parser.parse_args(sys.argv[2:])
+        from src.Progress import status_path, read_status, format_status
+        path = status_path(args)
+        if path is None:
+            parser.error('give the output folder (-o) or the status file (--status-file) of the run')
+        try:
+            status = read_status(path)
+        except FileNotFoundError:
+            parser.error('no status file at {}, the run has not saved its progress yet'.format(path))
+        if args.json:
+            import json
+            print(json.dumps(status, indent=2))
+        else:
+            print(format_status(status, args.top))
+        return
+
+    parser = generate_parser(command)
+    args = parser.parse_args(sys.argv[2:] if command else None)
+
+    if command == 'import-completed':
+        from src.Sinks import get_sink
+        from src.PlanExport import import_completed
+        sink = get_sink(args)
+        counts = {'completed': 0, 'skipped': 0, 'missing': 0}
+        for entry, status in import_completed(sink, args.plan_dir):
+            counts[status] += 1
+        sink.close()
+        logger.info('Imported {completed} completed files, {skipped} were already in the output '
+                    'and {missing} are not finished yet'.format(**counts))
+        return
+
+    if args.package and len(args.package) != len(args.manifest_file):
+        parser.error('one manifest (-m) is required for every package (-dp)')
+    if args.gunzip and (args.bundle or args.output.startswith('s3://')):
+        parser.error('--gunzip needs a plain output folder')
+
+    if args.explain:
+        from src.Selection import explain_selection
+        explain_selection(args)
+        return
+
+    # Imported here so --help and argument errors don't pay for pandas/requests
+    from src.Downloader import Downloader
+
+    if command == 'export-plan':
+        from src.PlanExport import export_plan
+        segments, exported, skipped = export_plan(Downloader(args, autostart=False), args)
+        logger.info('Exported {} files in {} segments to {}, {} were already downloaded'.format(
+            exported, len(segments), args.plan_dir, skipped))
+        return
 
-    ABCC_Downloader = Downloader(args)
+    Downloader(args)
 
 if __name__ == "__main__":  
 
@@ -0,0 +1,134 @@
+"""
+Reusable per-thread chunk buffers for the download loop.
+
+Each worker thread owns a single bytearray that is filled in place with
+readinto() and handed to the sink as a memoryview slice, so streaming a file
+does not allocate a new bytes object per chunk.  Peak buffer memory is
+therefore bounded by (number of worker threads) x (buffer size).
+
+urllib3's HTTPResponse.readinto() reads into a temporary bytes object and
+copies it into the buffer, so the reads go to the http.client response
+underneath it (which also handles chunked transfer encoding) through
+DirectReader. Bodies sent with a Content-Encoding are decoded like
+requests' iter_content() does, through DecodingReader.
+"""
+
+import http.client
+import socket
+import threading
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024 * 5
+# Encoded bytes read per call when a body has to be decoded
+DECODE_READ_SIZE = 1024 * 1024
+
+
+class BufferPool:
+    """ Hands out one reusable buffer per thread """
+
+    def __init__(self, buffer_size=DEFAULT_BUFFER_SIZE):
+        self.buffer_size = buffer_size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.allocated = 0
+
+    def get(self):
+        """
+        :return: memoryview over the calling thread's buffer
+        """
+        view = getattr(self.local, 'view', None)
+        if view is None:
+            view = self.local.view = memoryview(bytearray(self.buffer_size))
+            with self.lock:
+                self.allocated += 1
+        return view
+
+    @property
+    def peak_bytes(self):
+        return self.allocated * self.buffer_size
+
+
+class DirectReader:
+    """ readinto() of the http.client response under a urllib3 response, translating errors like urllib3 """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.fp = raw._fp
+
+    def readinto(self, b):
+        from urllib3.exceptions import ProtocolError, ReadTimeoutError
+        try:
+            n = self.fp.readinto(b)
+        except socket.timeout as e:
+            raise ReadTimeoutError(None, None, 'Read timed out.') from e
+        except (http.client.HTTPException, OSError) as e:
+            raise ProtocolError('Connection broken: {!r}'.format(e), e) from e
+        if self.fp.isclosed():
+            # The whole body was read, the connection can be reused like after urllib3's own reads
+            self.raw.release_conn()
+        return n
+
+
+class DecodingReader:
+    """ readinto() of the decoded body of a urllib3 response sent with a Content-Encoding """
+
+    def __init__(self, raw):
+        self.chunks = raw.stream(DECODE_READ_SIZE, decode_content=True)
+        self.pending = memoryview(b'')
+
+    def readinto(self, b):
+        while not self.pending:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.pending = memoryview(chunk)
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+
+def content_encoding(headers):
+    """ :return: the Content-Encoding of a response, None if its body is sent as is """
+    encoding = headers.get('Content-Encoding', '').strip().lower()
+    return encoding if encoding and encoding != 'identity' else None
+
+
+def body_reader(raw):
+    """
+    :param raw: requests' response.raw
+    :return: object with a readinto() method filling buffers with the response body, decoded if needed
+    """
+    if content_encoding(raw.headers):
+        return DecodingReader(raw)
+    if not hasattr(getattr(raw, '_fp', None), 'readinto'):
+        return raw
+    return DirectReader(raw)
+
+
+def read_chunks(raw, view):
+    """
+    Fills ``view`` from a file-like object until it is full or the stream ends
+    and yields the filled part. The yielded memoryview is only valid until the
+    next iteration since the same buffer is reused. If a read fails, the bytes
+    received before it are yielded before the error is raised.
+    :param raw: object with a readinto() method, e.g. requests' response.raw
+    :param view: memoryview returned by BufferPool.get()
+    """
+    size = len(view)
+    while True:
+        filled = 0
+        while filled < size:
+            try:
+                n = raw.readinto(view[filled:])
+            except BaseException:
+                # Hand over what was received before the read failed, so a retry resumes after it
+                if filled:
+                    yield view[:filled]
+                raise
+            if not n:
+                break
+            filled += n
+        if filled:
+            yield view[:filled]
+        if filled < size:
+            return
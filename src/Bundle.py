@@ -0,0 +1,530 @@
+"""
+Per-subject (or per-session) archive bundles.
+
+Instead of creating one file per download alias, every file belonging to the
+same subject/session is streamed into a single archive as it downloads.  Tar
+bundles carry a sidecar ``.idx`` file (one JSON line per completed member)
+so that members can be read back with a single seek, without extracting or
+scanning the archive.  Zip bundles rely on the zip central directory instead.
+"""
+
+import io
+import json
+import os
+import re
+import tarfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+BUNDLE_LEVELS = ('subject', 'session')
+BUNDLE_FORMATS = ('tar', 'zip')
+# Name of the placeholder members covering reserved regions of unfinished members
+FREE_MEMBER = '.bundle-free'
+
+SUBJECT_RE = re.compile(r'(sub-[^/._]+)')
+SESSION_RE = re.compile(r'(ses-[^/._]+)')
+
+
+def bundle_key(alias, level='subject'):
+    """
+    Returns the name of the bundle that a download alias belongs to
+    :param alias: download alias of a package file
+    :param level: 'subject' or 'session'
+    :return: bundle key such as sub-NDARINVXXXXXXX or sub-NDARINVXXXXXXX_ses-baselineYear1Arm1
+    """
+    subject = SUBJECT_RE.search(alias)
+    if not subject:
+        return 'other'
+    key = subject.group(1)
+    if level == 'session':
+        session = SESSION_RE.search(alias, subject.end())
+        if session:
+            key += '_' + session.group(1)
+    return key
+
+
+def _tar_header(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = int(time.time())
+    return info.tobuf(format=tarfile.GNU_FORMAT, encoding='utf-8', errors='surrogateescape')
+
+
+def _padded(size):
+    return (size + BLOCKSIZE - 1) // BLOCKSIZE * BLOCKSIZE
+
+
+class MemberWriter:
+    """
+    Writes a single member into the region reserved for it in its bundle.
+    Writes are positional, so the members of one bundle download in parallel
+    and the bundle is only locked to reserve and record them. abort() keeps
+    the region and the bytes received, the next open_member() of the same name
+    continues from them. A member whose size is not known in advance is
+    received in memory and only given its region by commit().
+    """
+
+    def __init__(self, bundle, name, size):
+        self.bundle = bundle
+        self.name = name
+        self.expected_size = size
+        self.header_offset = None
+        self.header_length = 0
+        self.data_offset = None
+        self.buffer = bytearray() if size is None else None
+        # Bytes kept from an earlier attempt
+        self.offset = 0
+        self.size = 0
+        self.crc = 0
+        # BundleSet to release the bundle to once the member is committed or aborted
+        self.bundle_set = None
+
+    def hash_prefix(self, hasher, buffer):
+        """ Feeds the bytes kept from earlier attempts to ``hasher`` """
+        position = 0
+        while position < self.offset:
+            data = os.pread(self.bundle.fd, min(self.offset - position, len(buffer)), self.data_offset + position)
+            if not data:
+                break
+            hasher.update(data)
+            position += len(data)
+
+    def restart(self):
+        """ Discards the bytes of earlier attempts """
+        self.offset = 0
+        self.size = 0
+        self.crc = 0
+        if self.buffer is not None:
+            del self.buffer[:]
+
+    def write(self, data):
+        if self.buffer is not None:
+            self.buffer += data
+        else:
+            if self.size + len(data) > self.expected_size:
+                raise ValueError('{} is larger than the {} bytes reserved for it'.format(
+                    self.name, self.expected_size))
+            view = memoryview(data)
+            while view:
+                n = os.pwrite(self.bundle.fd, view, self.data_offset + self.size + len(data) - len(view))
+                view = view[n:]
+        if self.bundle.crc:
+            self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        return len(data)
+
+    def commit(self):
+        try:
+            if self.buffer is not None:
+                self.bundle.reserve(self, len(self.buffer))
+                os.pwrite(self.bundle.fd, self.buffer, self.data_offset)
+                self.buffer = None
+            self.bundle.commit(self)
+        finally:
+            self.done()
+
+    def abort(self):
+        try:
+            self.bundle.keep(self)
+        finally:
+            self.done()
+
+    def done(self):
+        if self.bundle_set is not None:
+            self.bundle_set.release(self.bundle)
+            self.bundle_set = None
+
+
+class BundleWriter:
+    """
+    Base class of the bundle formats, which only differ in the member headers
+    and in how the completed members are recorded
+    """
+
+    # Whether the members' CRC-32 is needed
+    crc = False
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fd = None
+        # Offset at which the next member's region starts
+        self.end = 0
+        # Regions of aborted members, by name
+        self.kept = {}
+
+    def open_member(self, name, size=None):
+        """
+        Returns a writer for a new member, continuing an aborted attempt at it if there was one
+        :param name: member name, normally the download alias
+        :param size: expected size in bytes if known
+        """
+        with self.lock:
+            if self.fd is None:
+                self._open()
+            writer = self.kept.pop(name, None)
+        if writer is not None and writer.expected_size == size:
+            writer.offset = writer.size
+            return writer
+        # An aborted region of another size stays unused
+        writer = MemberWriter(self, name, size)
+        if size is not None:
+            self.reserve(writer, size)
+        return writer
+
+    def reserve(self, writer, size):
+        """ Reserves the region of the member's header and data at the end of the bundle """
+        writer.expected_size = size
+        with self.lock:
+            writer.header_offset = self.end
+            writer.header_length = self._header_length(writer.name, size)
+            writer.data_offset = self.end + writer.header_length
+            self.end = writer.data_offset + self._data_length(size)
+            self._reserved(writer)
+
+    def commit(self, writer):
+        self._write_header(writer)
+        with self.lock:
+            self._record(writer)
+
+    def keep(self, writer):
+        with self.lock:
+            if self.fd is not None and writer.data_offset is not None:
+                self.kept[writer.name] = writer
+
+    def contains(self, name, size=None):
+        raise NotImplementedError
+
+    def close(self):
+        with self.lock:
+            if self.fd is not None:
+                self._close()
+                self.fd = None
+            self.kept.clear()
+
+    def _data_length(self, size):
+        return size
+
+    def _reserved(self, writer):
+        pass
+
+
+class TarBundleWriter(BundleWriter):
+    """
+    Writes members to ``<path>`` and records their offsets in ``<path>.idx``.
+    Every reserved region starts out as a placeholder member named
+    FREE_MEMBER, so the bundle stays a readable tar file while members are
+    still being written and after an interrupted run.
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.index_path = path + '.idx'
+        self.index_fp = None
+        self.members = {}
+
+    def _open(self):
+        self.members = {}
+        self.end = 0
+        rewrite = False
+        if os.path.isfile(self.index_path) and os.path.isfile(self.path):
+            with open(self.index_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partially written line from an interrupted run
+                        rewrite = True
+                        continue
+                    self.members[entry['name']] = entry
+                    self.end = max(self.end, entry['offset'] + _padded(entry['size']))
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        # Drop the end-of-archive marker and anything not recorded in the index
+        os.ftruncate(self.fd, self.end)
+        if rewrite or not self.members:
+            with open(self.index_path, 'w') as f:
+                for entry in self.members.values():
+                    f.write(json.dumps(entry) + '\n')
+        self.index_fp = open(self.index_path, 'a')
+
+    def contains(self, name, size=None):
+        with self.lock:
+            if self.fd is None:
+                self._open()
+            entry = self.members.get(name)
+        return entry is not None and (size is None or entry['size'] == size)
+
+    def _header_length(self, name, size):
+        # GNU headers have the same length for a given name regardless of size
+        return len(_tar_header(name, size))
+
+    def _data_length(self, size):
+        return _padded(size)
+
+    def _reserved(self, writer):
+        self._free(writer.header_offset, self.end)
+
+    def _free(self, start, end):
+        """ Marks ``start`` to ``end`` as a placeholder member """
+        if end > start:
+            os.pwrite(self.fd, _tar_header(FREE_MEMBER, end - start - BLOCKSIZE), start)
+
+    def _write_header(self, writer):
+        padding = _padded(writer.size) - writer.size
+        if padding:
+            os.pwrite(self.fd, b'\0' * padding, writer.data_offset + writer.size)
+        os.pwrite(self.fd, _tar_header(writer.name, writer.size), writer.header_offset)
+        if writer.size != writer.expected_size:
+            # Fewer bytes than announced, the rest of the region stays a placeholder
+            self._free(writer.data_offset + _padded(writer.size), writer.data_offset + _padded(writer.expected_size))
+
+    def _record(self, writer):
+        entry = {'name': writer.name, 'header': writer.header_offset, 'offset': writer.data_offset,
+                 'size': writer.size}
+        self.members[writer.name] = entry
+        self.index_fp.write(json.dumps(entry) + '\n')
+        self.index_fp.flush()
+
+    def _close(self):
+        # End-of-archive marker so the bundle is also a regular tar file
+        os.pwrite(self.fd, b'\0' * (2 * BLOCKSIZE), self.end)
+        os.ftruncate(self.fd, self.end + 2 * BLOCKSIZE)
+        os.close(self.fd)
+        self.index_fp.close()
+        self.index_fp = None
+
+
+class ZipBundleWriter(BundleWriter):
+    """
+    Writes members to a zip archive. Unlike tar bundles the zip central
+    directory is only written on close(), so an interrupted run leaves an
+    unreadable bundle that must be downloaded again.
+    """
+
+    crc = True
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.zf = None
+
+    def _open(self):
+        self.zf = zipfile.ZipFile(self.path, 'a', compression=zipfile.ZIP_STORED, allowZip64=True)
+        self.end = self.zf.start_dir
+        self.fd = self.zf.fp.fileno()
+
+    def contains(self, name, size=None):
+        with self.lock:
+            if self.fd is None:
+                self._open()
+            info = self.zf.NameToInfo.get(name)
+        return info is not None and (size is None or info.file_size == size)
+
+    @staticmethod
+    def _info(name, size, crc=0):
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.external_attr = 0o644 << 16
+        info.file_size = info.compress_size = size
+        info.CRC = crc
+        return info
+
+    def _header_length(self, name, size):
+        # With the zip64 extra field the local header has the same length for any size
+        return len(self._info(name, size).FileHeader(zip64=True))
+
+    def _write_header(self, writer):
+        writer.info = self._info(writer.name, writer.size, writer.crc)
+        writer.info.header_offset = writer.header_offset
+        os.pwrite(self.fd, writer.info.FileHeader(zip64=True), writer.header_offset)
+
+    def _record(self, writer):
+        self.zf.filelist.append(writer.info)
+        self.zf.NameToInfo[writer.name] = writer.info
+        self.zf._didModify = True
+
+    def _close(self):
+        # The central directory follows the last reserved region
+        self.zf.start_dir = self.end
+        self.zf.close()
+        self.zf = None
+
+
+class BundleSet:
+    """
+    Maps download aliases to their bundle and keeps at most ``max_open``
+    bundles open at a time. Bundles are used between acquire() and release()
+    (or in a use() block); only bundles nobody uses are closed and forgotten,
+    so there is never more than one writer per bundle file.
+    """
+
+    def __init__(self, root, level='subject', fmt='tar', max_open=64):
+        if level not in BUNDLE_LEVELS:
+            raise ValueError('Invalid bundle level: {}'.format(level))
+        if fmt not in BUNDLE_FORMATS:
+            raise ValueError('Invalid bundle format: {}'.format(fmt))
+        self.root = root
+        self.level = level
+        self.fmt = fmt
+        self.max_open = max_open
+        self.bundles = OrderedDict()
+        # Number of callers using each bundle, by path
+        self.users = Counter()
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, alias):
+        return os.path.join(self.root, '{}.{}'.format(bundle_key(alias, self.level), self.fmt))
+
+    def acquire(self, alias):
+        """ The bundle of ``alias``, which stays open until it is passed to release() """
+        path = self.path_for(alias)
+        with self.lock:
+            bundle = self.bundles.get(path)
+            if bundle is None:
+                bundle = TarBundleWriter(path) if self.fmt == 'tar' else ZipBundleWriter(path)
+                self.bundles[path] = bundle
+            self.bundles.move_to_end(path)
+            self.users[path] += 1
+            self._evict()
+        return bundle
+
+    def release(self, bundle):
+        with self.lock:
+            self.users[bundle.path] -= 1
+            if not self.users[bundle.path]:
+                del self.users[bundle.path]
+
+    def open_member(self, alias, size=None):
+        """ Writer for ``alias`` in its bundle, which stays open until the writer is committed or aborted """
+        bundle = self.acquire(alias)
+        try:
+            writer = bundle.open_member(alias, size)
+        except BaseException:
+            self.release(bundle)
+            raise
+        writer.bundle_set = self
+        return writer
+
+    @contextmanager
+    def use(self, alias):
+        bundle = self.acquire(alias)
+        try:
+            yield bundle
+        finally:
+            self.release(bundle)
+
+    def _evict(self):
+        """ Closes and forgets the least recently used idle bundles beyond max_open """
+        excess = len(self.bundles) - self.max_open
+        if excess <= 0:
+            return
+        stale = []
+        for path in self.bundles:
+            if path not in self.users:
+                stale.append(path)
+                if len(stale) == excess:
+                    break
+        # Closed bundles are reopened in append mode the next time they are used
+        for path in stale:
+            self.bundles.pop(path).close()
+
+    def close(self):
+        with self.lock:
+            for bundle in self.bundles.values():
+                bundle.close()
+            self.bundles.clear()
+
+
+class MemberReader(io.RawIOBase):
+    """ Read-only, seekable view of a single member inside a tar bundle """
+
+    def __init__(self, path, offset, size):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.offset = offset
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+        data = os.pread(self.fd, n, self.offset + self.pos)
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.size
+        self.pos = max(0, pos)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            os.close(self.fd)
+        super().close()
+
+
+class BundleReader:
+    """ Random access to single members of a tar or zip bundle without extracting it """
+
+    def __init__(self, path):
+        self.path = path
+        self.zf = None
+        self.members = {}
+        if zipfile.is_zipfile(path):
+            self.zf = zipfile.ZipFile(path, 'r')
+        else:
+            with open(path + '.idx', 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.members[entry['name']] = entry
+
+    def names(self):
+        if self.zf is not None:
+            return self.zf.namelist()
+        return list(self.members)
+
+    def size(self, name):
+        if self.zf is not None:
+            return self.zf.getinfo(name).file_size
+        return self.members[name]['size']
+
+    def open(self, name):
+        if self.zf is not None:
+            return self.zf.open(name, 'r')
+        entry = self.members[name]
+        return io.BufferedReader(MemberReader(self.path, entry['offset'], entry['size']))
+
+    def read(self, name):
+        with self.open(name) as f:
+            return f.read()
+
+    def close(self):
+        if self.zf is not None:
+            self.zf.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,345 @@
+"""
+Shared read-through cache for S3 downloads.
+
+`download.py serve-cache` runs a small HTTP service that downloaders on the
+same cluster point at with --cache-proxy. Instead of fetching a presigned URL
+directly, a downloader requests
+
+    GET /fetch?url=<presigned URL>
+
+and the service answers from its on-disk cache, fetching the object from S3
+only the first time anyone asks for it. Concurrent requests for the same
+object share one upstream fetch and are served from the cache file while it
+is still being written. The cache is bounded by size and evicts the least
+recently used objects.
+
+Authorization stays with every user's own NDA credentials: before serving an
+object the service checks with a one byte request that the caller's
+presigned URL is accepted by S3, so only users the NDA API issued a URL for
+the object to get it from the cache. Objects are identified by their S3 host
+and path, the signature in the query string is ignored.
+
+Only https URLs of AWS S3 hosts are fetched, plus the origins given with
+--allow-origin (e.g. an S3-compatible test endpoint), and redirects are not
+followed, so the service cannot be used as a proxy into the cluster network.
+By default it only listens on the loopback interface.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import sys
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+from src.utils import DEFAULT_RETRY_POLICY, human_size
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+logger.addHandler(ch)
+
+DEFAULT_PORT = 8642
+DEFAULT_BIND = '127.0.0.1'
+CHUNK_SIZE = 1024 * 1024
+RANGE_RE = re.compile(r'bytes=(\d+)-(\d*)$')
+# Virtual-hosted and path style S3 endpoints, e.g. nda-central.s3.amazonaws.com or s3.us-east-1.amazonaws.com
+S3_HOST_RE = re.compile(r'([a-z0-9][a-z0-9.-]*\.)?s3([.-][a-z0-9-]+)*\.amazonaws\.com\Z')
+
+
+def proxied_url(proxy, url):
+    """ URL of ``url`` fetched through the cache service at ``proxy`` """
+    return '{}/fetch?url={}'.format(proxy.rstrip('/'), quote(url, safe=''))
+
+
+def is_allowed(url, allowed_origins=()):
+    """
+    True if the service may fetch ``url``: an https URL of an AWS S3 host or a URL on one of ``allowed_origins``
+    :param allowed_origins: extra origins such as 'http://minio.example.org:9000'
+    """
+    parts = urlsplit(url)
+    if '{}://{}'.format(parts.scheme, parts.netloc).lower() in allowed_origins:
+        return True
+    try:
+        port = parts.port
+    except ValueError:
+        return False
+    return (parts.scheme == 'https' and port in (None, 443) and not parts.username
+            and S3_HOST_RE.match(parts.hostname or '') is not None)
+
+
+def object_key(url):
+    """ Cache key of a presigned URL, the same for every signature of an object """
+    parts = urlsplit(url)
+    return hashlib.sha256('{}{}'.format(parts.netloc, parts.path).encode()).hexdigest()
+
+
+class UpstreamError(Exception):
+    """ The object could not be fetched from S3 """
+
+    def __init__(self, message, status=502):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class CacheEntry:
+    """ An object in the cache, possibly still being fetched """
+
+    def __init__(self, key, path, size=None, done=False):
+        self.key = key
+        self.path = path
+        self.size = size
+        self.written = size if done else 0
+        self.done = done
+        self.error = None
+        self.readers = 0
+        self.condition = threading.Condition()
+
+    def wait_for_size(self):
+        with self.condition:
+            while self.size is None and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            return self.size
+
+    def wait_for(self, offset):
+        """ Blocks until bytes past ``offset`` are in the cache file, returns how many bytes are """
+        with self.condition:
+            while self.written <= offset and not self.done and self.error is None:
+                self.condition.wait()
+            if self.error is not None:
+                raise self.error
+            return self.written
+
+    def update(self, size=None, written=None, done=False, error=None):
+        with self.condition:
+            if size is not None:
+                self.size = size
+            if written is not None:
+                self.written = written
+            self.done = self.done or done
+            self.error = error
+            self.condition.notify_all()
+
+
+class ObjectCache:
+    """ Size bounded LRU cache of S3 objects in a directory, filled by one fetch per object """
+
+    def __init__(self, root, max_bytes, timeout=(30, 60)):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.entries = OrderedDict()
+        self.total = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        # Objects cached by earlier runs, least recently used first
+        cached = []
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name.endswith('.partial'):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            cached.append((stat.st_atime, name, stat.st_size))
+        for _, name, size in sorted(cached):
+            self.entries[name] = CacheEntry(name, os.path.join(root, name), size, done=True)
+            self.total += size
+        logger.info('Cache {} holds {} objects ({} of {})'.format(
+            root, len(self.entries), human_size(self.total), human_size(max_bytes)))
+
+    def acquire(self, url):
+        """
+        Returns the cache entry of ``url``, starting its upstream fetch if nobody did yet.
+        Every acquire() has to be followed by release().
+        """
+        key = object_key(url)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry.error is not None:
+                entry = CacheEntry(key, os.path.join(self.root, key))
+                self.entries[key] = entry
+                threading.Thread(target=self._fill, args=(entry, url), daemon=True).start()
+            self.entries.move_to_end(key)
+            entry.readers += 1
+        return entry
+
+    def release(self, entry):
+        with self.lock:
+            entry.readers -= 1
+            self._evict()
+
+    def _evict(self):
+        for key, entry in list(self.entries.items()):
+            if self.total <= self.max_bytes:
+                return
+            if entry.readers or not entry.done:
+                continue
+            del self.entries[key]
+            self.total -= entry.size
+            os.remove(entry.path)
+            logger.info('Evicted {} ({})'.format(key, human_size(entry.size)))
+
+    def _fill(self, entry, url):
+        import requests
+
+        partial = entry.path + '.partial'
+        reserved = 0
+        try:
+            response = DEFAULT_RETRY_POLICY.call(url, requests.get, url, stream=True, timeout=self.timeout,
+                                                 allow_redirects=False)
+            with response:
+                if response.status_code != 200:
+                    raise UpstreamError('S3 returned {} for {}'.format(response.status_code, url.split('?')[0]),
+                                        response.status_code)
+                size = int(response.headers['Content-Length'])
+                with self.lock:
+                    self.total += size
+                    reserved = size
+                    self._evict()
+                written = 0
+                with open(partial, 'wb') as f:
+                    # Readers open the cache file once they know the size
+                    entry.update(size=size)
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        # Readers read the file directly, so flush before announcing the bytes
+                        f.flush()
+                        written += len(chunk)
+                        entry.update(written=written)
+                if written != size:
+                    raise UpstreamError('Received {} of {} bytes for {}'.format(written, size, url.split('?')[0]))
+            os.rename(partial, entry.path)
+            entry.update(done=True)
+            logger.info('Cached {} ({})'.format(url.split('?')[0], human_size(size)))
+        except Exception as e:
+            error = e if isinstance(e, UpstreamError) else UpstreamError(str(e))
+            with self.lock:
+                if self.entries.get(entry.key) is entry:
+                    del self.entries[entry.key]
+                self.total -= reserved
+            entry.update(error=error)
+            if os.path.exists(partial):
+                os.remove(partial)
+            logger.info('Fetching {} failed: {}'.format(url.split('?')[0], error))
+
+
+def authorize(url, timeout=(30, 60)):
+    """
+    Checks that S3 accepts the caller's presigned URL, by requesting its first byte
+    :return: the HTTP status code of S3's answer
+    """
+    import requests
+
+    response = DEFAULT_RETRY_POLICY.call(url, requests.get, url, headers={'Range': 'bytes=0-0'},
+                                         stream=True, timeout=timeout, allow_redirects=False)
+    response.close()
+    return response.status_code
+
+
+class CacheRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        urls = parse_qs(parts.query).get('url')
+        if parts.path != '/fetch' or not urls:
+            self.send_error(404, 'Use /fetch?url=<presigned URL>')
+            return
+        url = urls[0]
+        if not is_allowed(url, self.server.allowed_origins):
+            self.send_error(403, 'Only presigned S3 URLs are served')
+            return
+        status = authorize(url)
+        if status not in (200, 206):
+            self.send_error(status if 400 <= status < 600 else 502, 'S3 rejected the presigned URL')
+            return
+
+        cache = self.server.cache
+        entry = cache.acquire(url)
+        try:
+            try:
+                size = entry.wait_for_size()
+            except UpstreamError as e:
+                self.send_error(e.status if 400 <= e.status < 600 else 502, str(e))
+                return
+            start = 0
+            end = size - 1
+            match = RANGE_RE.match(self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2)), end) if match.group(2) else end
+                if start > end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */{}'.format(size))
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.end_headers()
+            self.send_body(entry, start, end + 1)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        except UpstreamError:
+            # Headers are already sent, closing the connection makes the client retry
+            self.close_connection = True
+        finally:
+            cache.release(entry)
+
+    def send_body(self, entry, start, end):
+        """ Streams bytes [start, end) of the entry, following its cache file while it is being fetched """
+        offset = start
+        try:
+            f = open(entry.path + '.partial', 'rb')
+        except FileNotFoundError:
+            # Fetched completely in the meantime
+            f = open(entry.path, 'rb')
+        with f:
+            while offset < end:
+                available = min(entry.wait_for(offset), end)
+                f.seek(offset)
+                while offset < available:
+                    chunk = f.read(min(CHUNK_SIZE, available - offset))
+                    self.wfile.write(chunk)
+                    offset += len(chunk)
+
+
+class CacheServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cache, allowed_origins=()):
+        ThreadingHTTPServer.__init__(self, address, CacheRequestHandler)
+        self.cache = cache
+        self.allowed_origins = {origin.rstrip('/').lower() for origin in allowed_origins}
+
+    def handle_error(self, request, client_address):
+        # Downloaders close their connection after every file
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        ThreadingHTTPServer.handle_error(self, request, client_address)
+
+
+def serve_cache(root, max_bytes, host=DEFAULT_BIND, port=DEFAULT_PORT, allowed_origins=()):
+    """
+    Runs the cache service until interrupted
+    :param allowed_origins: origins fetched besides https AWS S3 hosts, e.g. 'http://minio.example.org:9000'
+    """
+    server = CacheServer((host, port), ObjectCache(root, max_bytes), allowed_origins)
+    logger.info('Serving the download cache on http://{}:{}'.format(host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,188 @@
+"""
+Disk space admission control for the download queue.
+
+Every file is admitted before it is queued and reserves its size (from the
+package metadata) until it has been handled, so the bytes of queued and
+in-flight files are accounted for before any of them is written. A file is
+only admitted while the free space on the output filesystem, and the quota
+headroom if one was given, stays above the watermark after subtracting all
+reservations. Otherwise queueing pauses, and resumes on its own once other
+files finish or space is freed on the filesystem. Only a file that can
+never fit, larger than the whole filesystem or than what is left of the
+quota (above the watermark), fails right away instead of pausing the run
+forever.
+
+Reservations are conservative: the space of a preallocated or partially
+written file is counted both as used on the filesystem and as reserved
+until the file is done.
+"""
+
+import errno
+import logging
+import os
+import threading
+
+from src.utils import human_size
+
+logger = logging.getLogger(__name__)
+
+# Errors meaning the output filesystem or the user's quota is full
+NO_SPACE_ERRNOS = (errno.ENOSPC, getattr(errno, 'EDQUOT', errno.ENOSPC))
+
+
+def is_out_of_space(error):
+    return isinstance(error, OSError) and error.errno in NO_SPACE_ERRNOS
+
+
+class InsufficientSpace(OSError):
+    """ A file can never fit in the output filesystem or quota, however much space is freed """
+
+    def __init__(self, message):
+        OSError.__init__(self, errno.ENOSPC, message)
+
+
+def _statvfs(path):
+    while path and not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.statvfs(path or '.')
+
+
+def free_bytes(path):
+    """ Bytes available to unprivileged users on the filesystem holding ``path`` """
+    stat = _statvfs(path)
+    return stat.f_bavail * stat.f_frsize
+
+
+def total_bytes(path):
+    """ Size of the filesystem holding ``path`` """
+    stat = _statvfs(path)
+    return stat.f_blocks * stat.f_frsize
+
+
+class SpaceReservations:
+    """
+    Admits files as long as they fit above the free space watermark.
+    """
+
+    def __init__(self, path, watermark=0, quota=None, poll_interval=10, log=logger):
+        """
+        :param path: output directory
+        :param watermark: bytes that must stay free on the filesystem
+        :param quota: quota headroom in bytes at the start of the run, or None
+        :param poll_interval: seconds between free space checks while paused
+        :param log: logger pauses and resumes are logged to
+        """
+        self.log = log
+        self.path = path
+        self.watermark = watermark
+        self.quota = quota
+        self.poll_interval = poll_interval
+        self.reserved = 0
+        self.reservations = 0
+        # Bytes of completed files, they count against the quota headroom
+        self.written = 0
+        self.paused = False
+        self.condition = threading.Condition()
+
+    def available(self):
+        """ Bytes that can still be reserved before reaching the watermark """
+        available = free_bytes(self.path)
+        if self.quota is not None:
+            available = min(available, self.quota - self.written)
+        return available - self.reserved - self.watermark
+
+    def check_fits(self, size):
+        """ Raises InsufficientSpace if ``size`` bytes can never fit, however much space is freed """
+        if self.quota is not None and size > self.quota - self.written - self.watermark:
+            raise InsufficientSpace('{} needed, only {} left of the quota above the watermark'.format(
+                human_size(size), human_size(max(0, self.quota - self.written - self.watermark))))
+        capacity = total_bytes(self.path) - self.watermark
+        if size > capacity:
+            raise InsufficientSpace('{} needed, the filesystem only holds {} above the watermark'.format(
+                human_size(size), human_size(max(0, capacity))))
+
+    def admit(self, size, cancelled=None, block=True):
+        """
+        Blocks until ``size`` bytes can be reserved, then reserves them
+        :param size: file size in bytes, None if unknown
+        :param cancelled: threading.Event that stops waiting
+        :param block: wait for space, otherwise return False right away if there is not enough
+        :return: False if waiting was cancelled
+        :raises InsufficientSpace: if the file can never fit
+        """
+        size = size or 0
+        with self.condition:
+            while True:
+                if cancelled is not None and cancelled.is_set():
+                    return False
+                available = self.available()
+                if size <= available:
+                    break
+                self.check_fits(size)
+                if not block:
+                    return False
+                if not self.paused:
+                    self.paused = True
+                    self.log.warning('Pausing the download queue, {} free above the watermark with {} reserved by '
+                                '{} files and {} needed for the next file'.format(
+                                    human_size(max(0, available)), human_size(self.reserved),
+                                    self.reservations, human_size(size)))
+                # Woken early when a reservation is released
+                self.condition.wait(self.poll_interval)
+            if self.paused:
+                self.paused = False
+                self.log.warning('Resuming the download queue, {} free above the watermark'.format(
+                    human_size(available)))
+            self.reserved += size
+            self.reservations += 1
+        return True
+
+    def release(self, size, written=0):
+        """
+        Returns a file's reservation once it has been handled
+        :param written: bytes of the file that were written to the output
+        """
+        with self.condition:
+            self.reserved -= size or 0
+            self.reservations -= 1
+            self.written += written
+            self.condition.notify_all()
+
+    def wake(self):
+        """ Makes waiting callers check their cancelled event right away """
+        with self.condition:
+            self.condition.notify_all()
+
+    def wait_for_space(self, size, cancelled=None):
+        """
+        Called by a worker that ran out of space mid-transfer, blocks until
+        ``size`` more bytes are free on the filesystem
+        :return: False if waiting was cancelled
+        :raises InsufficientSpace: if the file can never fit
+        """
+        size = size or 0
+        self.log.warning('Output filesystem is full, waiting for {} to be freed'.format(human_size(size)))
+        with self.condition:
+            while True:
+                available = free_bytes(self.path) - self.watermark
+                if available >= size:
+                    break
+                if cancelled is not None and cancelled.is_set():
+                    return False
+                self.check_fits(size)
+                self.condition.wait(self.poll_interval)
+        return True
+
+
+def get_space_reservations(args, log=logger):
+    """
+    :param args: argparse namespace, uses output, min_free_space and disk_quota (GB)
+    :param log: logger pauses and resumes are logged to
+    :return: SpaceReservations, or None for outputs without a local filesystem
+    """
+    if args.output.startswith('s3://'):
+        return None
+    min_free_space = getattr(args, 'min_free_space', None) or 0
+    disk_quota = getattr(args, 'disk_quota', None)
+    return SpaceReservations(args.output, watermark=int(min_free_space * 1024 ** 3),
+                             quota=int(disk_quota * 1024 ** 3) if disk_quota is not None else None, log=log)
@@ -10,20 +10,29 @@ import os
 import sys
 import logging
 import argparse
+import hashlib
+import threading
+import time
 
-import getpass
-import keyring
-
-import pandas as pd
-
-import requests
-from requests import HTTPError
-
+from collections import OrderedDict, deque, namedtuple
 from queue import Queue
 from threading import Thread
 import multiprocessing
 
 from src.utils import *
+from src.Sinks import get_sink, get_stripe_size, align_buffer_size
+from src.Bundle import bundle_key
+from src.Buffers import BufferPool, body_reader, content_encoding, read_chunks, DEFAULT_BUFFER_SIZE
+from src.Metrics import TransferMetrics, BatchedLog
+from src.Selection import SubsetMatcher
+from src.FileStore import FileStore
+from src.DiskSpace import InsufficientSpace, get_space_reservations, is_out_of_space
+from src.Profiling import get_profiler
+from src.Progress import get_progress
+from src.CacheProxy import proxied_url
+from src.WorkerProcesses import WorkerProcesses
+from src.Watchdog import TransferMonitor, WatchedStream, IncompleteTransfer
+from src.Integrity import GzipVerifier, CorruptFile
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -34,6 +43,9 @@ logger.addHandler(ch)
 
 HOME = os.path.expanduser("~")
 HERE = os.path.dirname(os.path.abspath(sys.argv[0]))
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Files up to this size are received in memory and written with a single call
+SMALL_FILE_SIZE = 1024 * 1024
 
 def generate_parser():
 
@@ -132,192 +144,647 @@ class ThreadPool:
         """ Wait for completion of all the tasks in the queue """
         self.tasks.join()
 
-class Downloader:
-
-    def __init__(self, args):
+CompletionRecord = namedtuple('CompletionRecord', ['alias', 'path', 'bytes', 'checksum', 'status', 'error'])
+CompletionRecord.__doc__ = """
+Reported for every package file once it has been handled. status is one of
+'completed', 'skipped' (already present in the sink), 'failed' or 'cancelled'.
+"""
 
-        user_auth = Authenticator()
-        self.auth = user_auth.auth
-        # ID of data package that was created by user on the NDA
-        self.package_id = args.package
-        self.package_url = 'https://nda.nih.gov/api/package'
 
-        # Datastructure manifest that is automatically included in the data package (TODO: Download instead of input)
-        self.manifest = pd.read_csv(args.manifest_file,'\t')
+class Downloader:
+    """
+    Downloads the selected files of an NDA data package.
 
-        # List of data subsets that the user intends to download
-        self.data_basenames = args.basenames_file
+    Creating a Downloader loads the manifest and resolves the selection
+    (planning). With ``autostart=False`` nothing is downloaded until the
+    caller iterates over iter_completed() (or aiter_completed() from asyncio),
+    which yields a CompletionRecord as each file lands:
 
-        # List of subjects
-        self.subject_list_file = args.subject_list_file
-        self.subject_list = self.get_subject_list()
+        downloader = Downloader.from_options(package='1234567', manifest_file='datastructure_manifest.txt',
+                                             output='/scratch/abcc', autostart=False)
+        for record in downloader.iter_completed():
+            process(record.path)
 
-        # Create a list of the manifest names
-        self.manifest_names = self.generate_manifest_list()
+    Breaking out of the loop or calling cancel() stops the download.
+    """
 
-        self.s3_links_arr = self.manifest[self.manifest['manifest_name'].isin(self.manifest_names)]['associated_file'].values
+    def __init__(self, args, auth=None, autostart=True, select=True):
+        """
+        :param args: argparse namespace with the options of download.py, see from_options()
+        :param auth: requests auth object for the NDA API, prompted for on first use if not given
+        :param autostart: download everything right away, as the command line does
+        :param select: read the manifests and select the files to download
+        """
+        self.args = args
+        self._auth = auth
+        # Timed spans of every stage when --profile is given, no-ops otherwise
+        self.profiler = get_profiler(args)
+        # Running totals by subset and subject, saved to the status file read by `download.py status`
+        self.progress = get_progress(args, logger)
+        self.cancelled = threading.Event()
+        self.completed = None
+        self.package_url = 'https://nda.nih.gov/api/package'
+        # Worker processes of a multi-process run receive their files from the
+        # coordinating process and skip the selection
+        if select:
+            self.select_packages(args)
 
-        # Initialize hashmap of package file id to file metadata
-        self.local_file_names = {}
-        # Initialize hashmap of package file id to presigned url
-        self.presigned_urls = {}
+        # Package files and presigned URLs of the files not handled yet
+        self.files = FileStore()
 
         self.download_directory = args.output
 
+        # Local files (default), subject/session bundles or an S3-compatible object store
+        with self.profiler.span('open sink'):
+            self.sink = get_sink(args)
+        # Keeps the bytes of queued and in-flight files below the free space of the output filesystem
+        self.space = get_space_reservations(args, logger)
+
         self.thread_num = args.workerThreads if args.workerThreads else max([1, multiprocessing.cpu_count() - 1])
+        # Number of worker processes, each running its own pool of thread_num threads
+        self.processes = getattr(args, 'processes', None) or 1
+        self.workers = None
+
+        # One reusable chunk buffer per worker thread, sized to a whole number of
+        # filesystem stripes so every write but the last is stripe aligned
+        buffer_size = getattr(args, 'buffer_size', None)
+        buffer_size = buffer_size * 1024 * 1024 if buffer_size else DEFAULT_BUFFER_SIZE
+        if not self.download_directory.startswith('s3://'):
+            stripe_size = getattr(args, 'stripe_size', None)
+            with self.profiler.span('detect stripe size'):
+                stripe_size = stripe_size * 1024 if stripe_size else get_stripe_size(self.download_directory)
+            buffer_size = align_buffer_size(buffer_size, stripe_size)
+        self.buffers = BufferPool(buffer_size)
+        self.metrics = TransferMetrics(self.buffers)
+
+        # One retry policy for the NDA API and S3, with a circuit breaker per host
+        max_retries = getattr(args, 'max_retries', None)
+        retry_budget = getattr(args, 'retry_budget', None)
+        self.retry_policy = RetryPolicy(max_attempts=(7 if max_retries is None else max_retries) + 1,
+                                        budget=900 if retry_budget is None else retry_budget)
+        # Aborts transfers that stop sending data or crawl below the throughput floor
+        first_byte_timeout = getattr(args, 'first_byte_timeout', None) or 60
+        idle_timeout = getattr(args, 'idle_timeout', None) or 60
+        self.monitor = TransferMonitor(first_byte_timeout=first_byte_timeout, idle_timeout=idle_timeout,
+                                       min_rate=(getattr(args, 'min_throughput', None) or 0) * 1024,
+                                       hedge=getattr(args, 'hedge', False), log=logger)
+        self.monitor.start()
+        # (connect, read) timeouts for S3 transfers, the read timeout is the hard
+        # upper bound while waiting for response headers
+        self.timeout = (30, max(first_byte_timeout, idle_timeout))
+        # Shared cache service (download.py serve-cache) that S3 objects are fetched through
+        self.cache_proxy = getattr(args, 'cache_proxy', None)
+
+        # Optional checksum of every downloaded file, reported in its CompletionRecord
+        self.checksum = getattr(args, 'checksum', None)
+
+        # One requests session per worker thread, so connections are reused from file to file
+        self.sessions = threading.local()
+        small_file_size = getattr(args, 'small_file_size', None)
+        self.small_file_size = SMALL_FILE_SIZE if small_file_size is None else small_file_size * 1024
+        self.small_file_log = BatchedLog(logger)
+
+        # Inline checks of .gz files while they download, optionally with a decompressed copy
+        self.check_nifti = getattr(args, 'check_nifti', False)
+        self.gunzip = getattr(args, 'gunzip', False)
+        self.verify_gzip = getattr(args, 'verify_gzip', False) or self.check_nifti or self.gunzip
 
         # Use generator function to get file metadata in batches given s3 urls
         # Populate Queue for downloading files given presigned url
         # Download
-        self.start()
-
+        if autostart:
+            self.start()
+
+    def select_packages(self, args):
+        """ Reads every package's manifest and selects the S3 links to download """
+        # IDs of the data packages that were created by user on the NDA, each with its own manifest
+        self.package_ids = args.package if isinstance(args.package, (list, tuple)) else [args.package]
+        manifest_files = args.manifest_file if isinstance(args.manifest_file, (list, tuple)) else [args.manifest_file]
+        if len(manifest_files) != len(self.package_ids):
+            raise ValueError('Provide one manifest per package ({} packages, {} manifests)'.format(
+                len(self.package_ids), len(manifest_files)))
+        self.package_id = self.package_ids[0]
+
+        # List of data subsets (exact basenames or patterns) that the user intends to download,
+        # optionally restricted to a list of subjects and sessions
+        self.data_basenames = args.basenames_file
+        self.subject_list_file = args.subject_list_file
+        logger.info('Selecting manifest rows')
+        logger.info('\tSubjects:\t%s' % (self.subject_list_file or 'All subjects'))
+        with self.profiler.span('compile selection'):
+            self.matcher = SubsetMatcher.from_args(args)
+
+        # Selected S3 links of every package. An S3 object that is part of several
+        # packages is only downloaded once, through the first package listing it.
+        self.package_links = OrderedDict()
+        # Data subset of every selected link, in the same order
+        self.package_subsets = {}
+        seen = set()
+        for package_id, manifest_file in zip(self.package_ids, manifest_files):
+            links, manifest_names = self.select_links(manifest_file)
+            selected = [i for i, link in enumerate(links) if link not in seen]
+            if getattr(args, 'bundle', None):
+                # Queue the files of a bundle together, so each bundle is opened once and not
+                # closed and reopened by BundleSet for every file of an interleaved manifest
+                selected.sort(key=lambda i: bundle_key(links[i], args.bundle))
+            links = [links[i] for i in selected]
+            seen.update(links)
+            self.package_links[package_id] = links
+            self.package_subsets[package_id] = [self.progress.select(manifest_names[i]) for i in selected]
+            logger.info('\tPackage {}: {} files selected'.format(package_id, len(links)))
+
+    @classmethod
+    def from_options(cls, manifest_file, output, package=None, auth=None, autostart=False, **options):
+        """
+        Creates a Downloader without going through the command line
+        :param options: any other option of download.py by its dest name, e.g. workerThreads=10
+        """
+        defaults = {
+            'subject_list_file': None,
+            'basenames_file': os.path.join(REPO_ROOT, 'data_subsets.txt'),
+            'workerThreads': None,
+        }
+        defaults.update(options)
+        args = argparse.Namespace(manifest_file=manifest_file, output=output, package=package, **defaults)
+        return cls(args, auth=auth, autostart=autostart)
+
+    @property
+    def auth(self):
+        if self._auth is None:
+            self._auth = Authenticator().auth
+        return self._auth
 
     @staticmethod
     def request_header():
         return {'content-type': 'application/json'}
+
+    def select_links(self, manifest_file):
+        """ S3 links and manifest names of the manifest rows selected by the basenames, subjects and sessions """
+        # Datastructure manifest that is automatically included in the data package (TODO: Download instead of input)
+        import pandas as pd
+        with self.profiler.span('read manifest', manifest=manifest_file):
+            manifest = pd.read_csv(manifest_file, sep='\t')
+
+        # Match every manifest_name once against the compiled selection
+        with self.profiler.span('select rows', rows=len(manifest)):
+            selected = self.matcher.mask(manifest['manifest_name'].values)
+            return manifest[selected]['associated_file'].values, manifest[selected]['manifest_name'].values
     
-    def get_subject_list(self):
+    def start(self):
+        """ Downloads every selected file, as the command line does """
+        for record in self.iter_completed():
+            pass
+
+    def plan(self, make_directories=True):
         """
-        If a list of subject is provided then use that, else collect all unique
-        subject ids from the s3 spreadsheet and use that instead
-        :param manifest_df: pandas dataframe created from the s3 csv
-        :param subject_list_file: cli path to file containing list of subjects
-        :return: subject_list
+        Resolves the selected S3 links into package files batch by batch,
+        alternating between packages so that all of them progress at the same pace
+        :param make_directories: create the target directories of every batch in the sink
+        :return: generator of lists of package files, each with its presigned URL
+        and target directories ready
         """
-        subject_list = set()
-
-        print('Collecting Subjects')
-        logger.info('Logger Collecting Subjects')
-
-        if self.subject_list_file:
-            logger.info('\tSubjects:\t%s' % self.subject_list_file)
-            subject_list = [line.rstrip('\n') for line in open(self.subject_list_file)]
-
-        # Otherwise get all subjects from the S3 spreadsheet
-        else:
-            logger.info('\tSubjects:\tAll subjects')
-            for manifest_name in self.manifest['manifest_name'].values:
-                subject_id = manifest_name.split('.')[0]
-                subject_list.add(subject_id)
-
-        return list(subject_list)
-
-    def generate_manifest_list(self):
+        directory_pool = ThreadPool(self.thread_num)
+        packages = deque((package_id, self.generate_download_file_ids(package_id, links, self.package_subsets[package_id]))
+                         for package_id, links in self.package_links.items())
+        while packages:
+            if self.cancelled.is_set():
+                return
+            package_id, batches = packages.popleft()
+            package_file_list = next(batches, None)
+            if package_file_list is None:
+                continue
+            packages.append((package_id, batches))
+            package_file_id_list = [f.package_file_id for f in package_file_list]
+            self.get_presigned_urls(package_file_id_list, package_id)
+            if not make_directories:
+                yield package_file_list
+                continue
+            # Create the batch's target directories once, in parallel, before any of its files are queued
+            with self.profiler.span('make directories', files=len(package_file_list)):
+                directory_pool.map(self.sink.make_directory, self.sink.plan_directories(
+                    [f.alias for f in package_file_list]))
+                directory_pool.wait_completion()
+            yield package_file_list
+
+    def iter_completed(self, progress_callback=None):
         """
-        Take the list of subjects and list of basenames and concatenate them to
-        match the ${SUBJECT}.${BASENAME}.manifest.json to match the manifest name
-        in the s3 file.
-        :param args: argparse namespace containing all CLI arguments. The specific
-        arguments used by this function are
-        :return: manifest_names: list of manifest_name
+        Runs the download and yields a CompletionRecord for every file as soon as it is handled
+        :param progress_callback: called with each CompletionRecord and the run's TransferMetrics
         """
+        self.completed = Queue()
+        errors = []
 
-        # if a subject list is not provided
-        basenames = [line.rstrip('\n') for line in open(self.data_basenames)]
-
-        manifest_names = []
-        for sub in self.subject_list:
-            for base in basenames:
-                manifest = sub + '.' + base + '.manifest.json'
-                manifest_names += [manifest]
-        return manifest_names
+        def run():
+            try:
+                self.execute()
+            except Exception as e:
+                errors.append(e)
+                self.progress.close('failed')
+            finally:
+                self.completed.put(None)
 
-    def start(self):
+        Thread(target=run, daemon=True).start()
+        finished = False
+        try:
+            while True:
+                record = self.completed.get()
+                if record is None:
+                    finished = True
+                    break
+                if progress_callback:
+                    progress_callback(record, self.metrics)
+                yield record
+        finally:
+            if not finished:
+                # The caller stopped iterating early
+                self.cancel()
+        if errors:
+            raise errors[0]
+
+    async def aiter_completed(self, progress_callback=None):
+        """ asyncio version of iter_completed(), the download runs in worker threads """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        records = self.iter_completed(progress_callback)
+        done = object()
+        # Its own thread, so the pending next() can still be waited for once the task was cancelled
+        executor = ThreadPoolExecutor(max_workers=1)
+        pending = None
+        try:
+            while True:
+                pending = executor.submit(next, records, done)
+                record = await asyncio.wrap_future(pending)
+                if record is done:
+                    return
+                yield record
+        finally:
+            if pending is not None and not pending.done():
+                # Cancelled while the thread waits for the next record, which
+                # arrives once the cancelled run has wound down
+                self.cancel()
+                await asyncio.wait({asyncio.wrap_future(pending)})
+            records.close()
+            executor.shutdown(wait=False)
+
+    def cancel(self):
+        """ Stops queueing new files and aborts the transfers in flight """
+        if self.cancelled.is_set():
+            return
+        self.cancelled.set()
+        self.monitor.abort_all('download cancelled')
+        if self.space is not None:
+            self.space.wake()
+        if self.workers is not None:
+            self.workers.stop()
+
+    def execute(self):
+        if self.processes > 1:
+            return self.execute_in_processes()
         download_pool = ThreadPool(self.thread_num)
         download_request_ct = 0
+        self.progress.start()
 
-        for package_file_list in self.generate_download_file_ids():
+        for package_file_list in self.plan():
             additional_file_ct = len(package_file_list)
             download_request_ct += additional_file_ct
-            package_file_id_list = [j['package_file_id'] for j in package_file_list]
-            self.get_presigned_urls(package_file_id_list)
             logger.info('Adding {} files to download queue. Queue contains {} files\n'.format(additional_file_ct, download_request_ct))
-            download_pool.map(self.download_from_url, package_file_list)
+            for package_file in package_file_list:
+                # Waits while the files already queued would fill the output filesystem
+                try:
+                    if self.space is not None and not self.space.admit(package_file.size, self.cancelled):
+                        break
+                except InsufficientSpace as e:
+                    self.refuse(package_file, e)
+                    continue
+                download_pool.add_task(self.download_from_url, package_file)
         
+        self.monitor.set_draining(download_pool.tasks)
         download_pool.wait_completion()
+        self.small_file_log.flush()
+        self.sink.close()
+        self.monitor.stop()
+        self.progress.close('cancelled' if self.cancelled.is_set() else 'finished')
+        logger.info(self.metrics.summary())
+        profile = self.profiler.close()
+        if profile:
+            logger.info(profile)
+            logger.info('Wrote trace to {}'.format(self.profiler.path))
 
         return
 
-    def generate_download_file_ids(self):
+    def execute_in_processes(self):
+        """ As execute(), but hands the planned files to worker processes, see src/WorkerProcesses.py """
+        self.workers = WorkerProcesses(self.args, self.processes, self.worker_completed, self.sink.location, logger)
+        # The chunk buffers are allocated in the worker processes
+        self.metrics.buffer_pool = None
+        download_request_ct = 0
+        self.progress.start()
+        try:
+            for package_file_list in self.plan():
+                download_request_ct += len(package_file_list)
+                logger.info('Adding {} files to download queue. Queue contains {} files\n'.format(
+                    len(package_file_list), download_request_ct))
+                admitted = []
+                for package_file in package_file_list:
+                    try:
+                        if self.space is not None and not self.space.admit(package_file.size, block=False):
+                            # Hand out what fits before waiting for the workers to free space
+                            self.workers.submit(admitted)
+                            admitted = []
+                            if not self.space.admit(package_file.size, self.cancelled):
+                                break
+                    except InsufficientSpace as e:
+                        self.refuse(package_file, e)
+                        continue
+                    admitted.append((package_file, self.files.url(package_file.package_file_id)))
+                    # The worker keeps its own copy
+                    self.files.release(package_file.package_file_id)
+                self.workers.submit(admitted)
+        finally:
+            self.workers.close()
+        self.sink.close()
+        self.monitor.stop()
+        self.progress.close('cancelled' if self.cancelled.is_set() else 'finished')
+        logger.info(self.metrics.summary())
+        profile = self.profiler.close()
+        if profile:
+            logger.info(profile)
+            logger.info('Wrote trace to {}'.format(self.profiler.path))
+
+    def worker_completed(self, record, package_file):
+        """ Merges a worker process's CompletionRecord into this run's metrics and reservations """
+        if record.status == 'completed':
+            self.metrics.add_file(record.bytes)
+        elif record.status == 'skipped':
+            self.metrics.add_skipped()
+        elif record.status == 'failed':
+            self.metrics.add_failed()
+        if self.space is not None and package_file is not None:
+            self.space.release(package_file.size, record.bytes if record.status == 'completed' else 0)
+        self.report(record, package_file)
+
+    def generate_download_file_ids(self, package_id, s3_links, subsets):
         batch_size = self.thread_num
-        batch_start = 0
-        batch_end = min(batch_size, len(self.s3_links_arr))
-        while True:
-            package_files = self.query_package_files_by_s3_url(self.s3_links_arr[batch_start:batch_end])
-            tmp = {r['package_file_id']:r for r in package_files}
-            self.local_file_names.update(tmp)
-            batch_start += batch_size
-            if batch_start >= len(self.s3_links_arr):
-                break
-            batch_end = min(batch_end + batch_size, len(self.s3_links_arr))
+        for batch_start in range(0, len(s3_links), batch_size):
+            batch = s3_links[batch_start:batch_start + batch_size]
+            package_files = self.files.add(package_id, self.query_package_files_by_s3_url(batch, package_id))
+            self.progress.resolve(package_files, batch, subsets[batch_start:batch_start + batch_size])
             yield package_files
 
 
-    def query_package_files_by_s3_url(self, s3_path_list):
-        url = self.package_url + '/{}/files'.format(self.package_id)
-        response = post_request(url, list(s3_path_list), auth=self.auth, error_handler=HttpErrorHandlingStrategy.reraise_status)
+    def query_package_files_by_s3_url(self, s3_path_list, package_id=None):
+        url = self.package_url + '/{}/files'.format(package_id or self.package_id)
+        with self.profiler.span('files lookup', files=len(s3_path_list)):
+            response = post_request(url, list(s3_path_list), auth=self.auth, error_handler=HttpErrorHandlingStrategy.reraise_status, retry_policy=self.retry_policy)
         response.raise_for_status()
         return response.json()
 
-    def get_presigned_urls(self, id_list):
+    def get_presigned_urls(self, id_list, package_id=None):
         """
         Stores key-value pairs of (key: package_file_id, value: presigned URL)
         :param id_list: List of package file IDs with max size of 50,000
+        :param package_id: package the files belong to, by default the first package
         """
+        package_id = package_id or self.package_id
         if len(id_list) == 1:
             file_id = id_list[0]
-            url = self.package_url + '/{}/files/{}/download_url'.format(self.package_id, file_id)
-            tmp = post_request(url,headers=self.request_header(),_json=id_list,auth=self.auth, error_handler=HttpErrorHandlingStrategy.reraise_status)
+            url = self.package_url + '/{}/files/{}/download_url'.format(package_id, file_id)
+            with self.profiler.span('presign', files=1):
+                tmp = post_request(url,headers=self.request_header(),_json=id_list,auth=self.auth, error_handler=HttpErrorHandlingStrategy.reraise_status, retry_policy=self.retry_policy)
             response = json.loads(tmp.text)
+            self.files.set_urls({file_id: response['downloadURL']})
             return response['downloadURL']
         else:
             # Use the batchGeneratePresignedUrls when retrieving multiple files
-            url = self.package_url + '/{}/files/batchGeneratePresignedUrls'.format(self.package_id)
-            tmp = post_request(url,headers=self.request_header(),_json=id_list,auth=self.auth, error_handler=HttpErrorHandlingStrategy.reraise_status)
+            url = self.package_url + '/{}/files/batchGeneratePresignedUrls'.format(package_id)
+            with self.profiler.span('presign', files=len(id_list)):
+                tmp = post_request(url,headers=self.request_header(),_json=id_list,auth=self.auth, error_handler=HttpErrorHandlingStrategy.reraise_status, retry_policy=self.retry_policy)
             response = json.loads(tmp.text)
-            self.presigned_urls.update({e['package_file_id']: e['downloadURL'] for e in response['presignedUrls']})
+            self.files.set_urls({e['package_file_id']: e['downloadURL'] for e in response['presignedUrls']})
             return
 
     def download_from_url(self, package_file):
-        package_file_id = package_file['package_file_id']
-        def get_http_adapter(s3_link):
-            bucket, path = deconstruct_s3_url(s3_link)
-            config = {'max_retries': 10}
-            #if ('.' in bucket):
-            #    return AltEndpointSSLAdapter(**config) # Not implemented
-            return HTTPAdapter(**config)
-
-        bytes_written = 0
-        alias = self.local_file_names[package_file_id]['download_alias']
-        completed_download = os.path.normpath(
-            os.path.join(self.download_directory, alias)
-            )
-        partial_download = os.path.normpath(
-            os.path.join(self.download_directory, alias + '.partial')
-            )
-        if os.path.isfile(partial_download):
-            downloaded = True
-            downloaded_size = os.path.getsize(partial_download)
-            resume_header = {'Range': 'bytes={}-'.format(downloaded_size)}
-            logger.info('Resuming download: {}'.format(partial_download))
+        written = 0
+        try:
+            with self.profiler.span('download', alias=package_file.alias):
+                written = self._download(package_file)
+        finally:
+            # The record and its presigned URL are not needed once the file was handled
+            self.files.release(package_file.package_file_id)
+            if self.space is not None:
+                self.space.release(package_file.size, written or 0)
+
+    def _download(self, package_file):
+        package_file_id = package_file.package_file_id
+        alias = package_file.alias
+        file_size = package_file.size
+        if self.cancelled.is_set():
+            return
+        with self.profiler.span('check sink'):
+            exists = self.sink.contains(alias, file_size)
+        if exists:
+            logger.info('Skipping download, already exists: {}'.format(alias))
+            self.metrics.add_skipped()
+            self.report(CompletionRecord(alias, self.sink.location(alias), file_size, None, 'skipped', None),
+                        package_file)
+            return
+        ps_url = self.files.url(package_file_id)
+        small = file_size is not None and file_size <= self.small_file_size
+        transfer = self.transfer_small if small else self.transfer
+        try:
+            while True:
+                try:
+                    writer, checksum = self.retry_policy.call(ps_url, transfer, ps_url, alias, file_size)
+                    break
+                except OSError as e:
+                    if self.space is None or not is_out_of_space(e):
+                        raise
+                    # The .partial file is kept, continue from it once space has been freed
+                    if not self.space.wait_for_space(file_size, self.cancelled):
+                        raise DownloadCancelled(alias) from e
+        except BaseException as e:
+            status = 'cancelled' if isinstance(e, DownloadCancelled) else 'failed'
+            if status == 'failed':
+                self.metrics.add_failed()
+            self.report(CompletionRecord(alias, self.sink.location(alias), None, None, status, str(e)), package_file)
+            raise
+        self.metrics.add_file(writer.size)
+        if checksum:
+            logger.info('Completed download: {} ({} {})'.format(writer.location, self.checksum, checksum))
+        elif small:
+            self.small_file_log.add(writer.location, writer.size)
         else:
-            os.makedirs(os.path.dirname(partial_download), exist_ok=True)
-            logger.info('Starting download: {}'.format(partial_download))
-        ps_url = self.presigned_urls[package_file_id]
-        with requests.session() as s:
-            s.mount(ps_url, get_http_adapter(ps_url))
-            with open(partial_download, 'wb') as download_file:
-                with s.get(ps_url, stream=True) as response:
-                    response.raise_for_status()
-                    for chunk in response.iter_content(chunk_size=1024 * 1024 * 5): # iterate 5MB chunks
-                        if chunk:
-                            bytes_written += download_file.write(chunk)
-        os.rename(partial_download, completed_download)
-        logger.info('Completed download: {}'.format(completed_download))
+            logger.info('Completed download: {}'.format(writer.location))
+        self.report(CompletionRecord(alias, writer.location, writer.size, checksum, 'completed', None), package_file)
+
+        return writer.size
+
+    def refuse(self, package_file, error):
+        """ Fails a file that does not fit in the output without queueing it """
+        logger.error('Not enough space for {}: {}'.format(package_file.alias, error.strerror))
+        self.files.release(package_file.package_file_id)
+        self.metrics.add_failed()
+        self.report(CompletionRecord(package_file.alias, self.sink.location(package_file.alias), None, None,
+                                     'failed', str(error)), package_file)
+
+    def report(self, record, package_file=None):
+        self.progress.finished(package_file, record)
+        if self.completed is not None:
+            self.completed.put(record)
+
+    def session(self):
+        """ This thread's requests session """
+        import requests
+
+        session = getattr(self.sessions, 'session', None)
+        if session is None:
+            session = self.sessions.session = requests.Session()
+        return session
+
+    def verifier(self, alias):
+        """ GzipVerifier for ``alias`` if it is a .gz file and verification is on, otherwise None """
+        if not self.verify_gzip or not alias.endswith('.gz'):
+            return None
+        output = None
+        if self.gunzip:
+            output = self.sink.open(alias[:-len('.gz')])
+            if output.offset:
+                output.restart()
+        return GzipVerifier(alias, output, nifti=self.check_nifti and alias.endswith('.nii.gz'))
+
+    def transfer_small(self, ps_url, alias, file_size):
+        """
+        Single attempt at downloading a small file into memory and writing it with
+        one call, retried by download_from_url. Small files are not watched by the
+        watchdog, the request timeouts bound them.
+        :return: the written file and its checksum if requested
+        """
+        if self.cancelled.is_set():
+            raise DownloadCancelled(alias)
+        url = proxied_url(self.cache_proxy, ps_url) if self.cache_proxy else ps_url
+        with self.profiler.span('request'):
+            response = self.session().get(url, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.content
+        # response.content is decoded, Content-Length counts the encoded bytes
+        content_length = None if content_encoding(response.headers) else response.headers.get('Content-Length')
+        if content_length is not None and len(data) != int(content_length):
+            raise IncompleteTransfer('Received {} of {} bytes for {}'.format(len(data), content_length, alias))
+        checksum = hashlib.new(self.checksum, data).hexdigest() if self.checksum else None
+        verifier = self.verifier(alias)
+        if verifier:
+            try:
+                with self.profiler.span('verify'):
+                    verifier.update(data)
+                    verifier.finish()
+            except BaseException:
+                verifier.abort()
+                raise
+        try:
+            with self.profiler.span('write'):
+                written = self.sink.put(alias, data)
+        except BaseException:
+            if verifier:
+                verifier.abort()
+            raise
+        if verifier:
+            verifier.commit()
+        return written, checksum
+
+    def transfer(self, ps_url, alias, file_size):
+        """
+        Single attempt at streaming a presigned URL into the sink, retried by download_from_url.
+        Bytes written by an earlier attempt are kept and only the rest is requested.
+        :return: the committed sink writer and the file's checksum if requested
+        """
+        if self.cancelled.is_set():
+            raise DownloadCancelled(alias)
+        buffer = self.buffers.get()
+        with self.profiler.span('open writer'):
+            writer = self.sink.open(alias, file_size)
+        transfer = self.monitor.begin(alias)
+        hasher = hashlib.new(self.checksum) if self.checksum else None
+        verifier = None
+        try:
+            verifier = self.verifier(alias)
+            headers = {'Range': 'bytes={}-'.format(writer.offset)} if writer.offset else None
+            # Connection (TLS handshake only for a new connection) and time to the response headers
+            with self.profiler.span('request'):
+                url = proxied_url(self.cache_proxy, ps_url) if self.cache_proxy else ps_url
+                response = self.session().get(url, stream=True, timeout=self.timeout, headers=headers)
+                encoded = content_encoding(response.headers)
+                if writer.offset and encoded:
+                    # The bytes kept are decoded, they cannot be continued with a range of the encoded body
+                    response.close()
+                    writer.restart()
+                    response = self.session().get(url, stream=True, timeout=self.timeout)
+                    encoded = content_encoding(response.headers)
+            with response:
+                response.raise_for_status()
+                if writer.offset and response.status_code != 206:
+                    # The server ignored the Range header and sends the whole file
+                    writer.restart()
+                self.monitor.attach(transfer, response)
+                if writer.offset:
+                    logger.info('Resuming download at byte {}: {}'.format(writer.offset, writer.location))
+                    if hasher:
+                        writer.hash_prefix(hasher, buffer)
+                    if verifier:
+                        writer.hash_prefix(verifier, buffer)
+                else:
+                    logger.info('Starting download: {}'.format(writer.location))
+                # Read straight into this worker's buffer instead of allocating a chunk per read
+                body_start = time.perf_counter()
+                write_time = 0
+                verify_time = 0
+                for chunk in read_chunks(WatchedStream(body_reader(response.raw), transfer), buffer):
+                    write_start = time.perf_counter()
+                    writer.write(chunk)
+                    write_time += time.perf_counter() - write_start
+                    if hasher:
+                        hasher.update(chunk)
+                    if verifier:
+                        verify_start = time.perf_counter()
+                        verifier.update(chunk)
+                        verify_time += time.perf_counter() - verify_start
+                # Reads, writes and checks alternate chunk by chunk, they are recorded as one span each
+                receive_time = time.perf_counter() - body_start - write_time - verify_time
+                self.profiler.add('receive', body_start, receive_time, {'bytes': writer.size - writer.offset})
+                self.profiler.add('write', body_start + receive_time, write_time)
+                if verifier:
+                    self.profiler.add('verify', body_start + receive_time + write_time, verify_time)
+                # Content-Length counts the encoded bytes of an encoded body
+                content_length = None if encoded else response.headers.get('Content-Length')
+                if content_length is not None and writer.size != writer.offset + int(content_length):
+                    raise IncompleteTransfer('Received {} of {} bytes for {}'.format(
+                        writer.size, writer.offset + int(content_length), alias))
+            if verifier:
+                verifier.finish()
+        except BaseException as e:
+            if verifier:
+                verifier.abort()
+            if isinstance(e, CorruptFile) and hasattr(writer, 'restart'):
+                # Resuming would keep the corrupt bytes, the next attempt starts over
+                writer.restart()
+            writer.abort()
+            raise
+        finally:
+            self.monitor.end(transfer)
+        try:
+            with self.profiler.span('commit'):
+                writer.commit()
+        except BaseException:
+            if verifier:
+                verifier.abort()
+            raise
+        if verifier:
+            verifier.commit()
+        return writer, hasher.hexdigest() if hasher else None
 
-        return
 
-            
+class DownloadCancelled(Exception):
+    """ Raised instead of retrying a download after Downloader.cancel() """
 
 
 class Authenticator:
@@ -327,6 +794,10 @@ class Authenticator:
         self.auth = self.get_auth()
 
     def get_auth(self):
+        import getpass
+        import keyring
+        import requests
+
         self.ndar_username = input('Enter your NIMH Data Archives username: ')
         try:
             self.ndar_password = keyring.get_password(self.service_name, self.ndar_username)
@@ -338,7 +809,7 @@ def main():
     parser = generate_parser()
     args = parser.parse_args()
 
-    ABCC_Downloader = Downloader(args)
+    Downloader(args)
 
 if __name__ == "__main__":  
 
@@ -0,0 +1,78 @@
+"""
+Compact in-memory store of the package files selected for download.
+
+The /files endpoint returns a JSON object per package file with many fields
+that are never used after planning. Only the fields the download needs are
+kept, in a __slots__ record per file, and both the record and its presigned
+URL are dropped as soon as the file has been handled, so memory use follows
+the number of files in flight rather than the size of the selection.
+"""
+
+import threading
+
+
+class PackageFile:
+    """ The fields of a /files result that the download needs """
+
+    __slots__ = ('package_file_id', 'package_id', 'alias', 'size', 'subset')
+
+    def __init__(self, package_file_id, package_id, alias, size=None, subset=None):
+        self.package_file_id = package_file_id
+        self.package_id = package_id
+        self.alias = alias
+        self.size = size
+        # Data subset (manifest basename) that selected the file, for progress reporting
+        self.subset = subset
+
+    @classmethod
+    def from_json(cls, package_id, result):
+        return cls(result['package_file_id'], package_id, result['download_alias'], result.get('file_size'))
+
+    def __repr__(self):
+        return 'PackageFile({!r}, {!r}, {!r}, {!r})'.format(self.package_file_id, self.package_id, self.alias, self.size)
+
+
+class FileStore:
+    """ Package files and presigned URLs keyed by package file ID """
+
+    def __init__(self):
+        self.files = {}
+        self.urls = {}
+        self.lock = threading.Lock()
+
+    def add(self, package_id, results):
+        """
+        Keeps the needed fields of a /files response
+        :return: list of PackageFile
+        """
+        package_files = [PackageFile.from_json(package_id, r) for r in results]
+        with self.lock:
+            for package_file in package_files:
+                self.files[package_file.package_file_id] = package_file
+        return package_files
+
+    def put(self, package_file, url):
+        """ Adds a single package file together with its presigned URL """
+        with self.lock:
+            self.files[package_file.package_file_id] = package_file
+            self.urls[package_file.package_file_id] = url
+
+    def get(self, package_file_id):
+        return self.files[package_file_id]
+
+    def set_urls(self, urls):
+        """ :param urls: dict of package file ID to presigned URL """
+        with self.lock:
+            self.urls.update(urls)
+
+    def url(self, package_file_id):
+        return self.urls[package_file_id]
+
+    def release(self, package_file_id):
+        """ Forgets a package file and its presigned URL once it has been handled """
+        with self.lock:
+            self.files.pop(package_file_id, None)
+            self.urls.pop(package_file_id, None)
+
+    def __len__(self):
+        return len(self.files)
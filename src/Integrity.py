@@ -0,0 +1,139 @@
+"""
+Inline integrity checks of gzip files.
+
+Most derivatives in the collection are .nii.gz. With --verify-gzip every
+.gz file is fed to an incremental decompressor chunk by chunk while it
+downloads, which checks the CRC-32 and length stored in the gzip trailer
+once the stream ends. A truncated or corrupt file is discarded and
+downloaded again right away instead of failing a processing job later, and
+the check costs no extra read of the file from disk.
+
+The decompressed bytes can also be used while they are at hand:
+--check-nifti validates the header of .nii.gz files (NIfTI-1 or NIfTI-2
+magic, number of dimensions, and that the image data fits in the file), and
+--gunzip writes an uncompressed copy next to every .gz file.
+"""
+
+import struct
+import zlib
+
+# Decompressed bytes produced per decompress() call, bounds memory for highly compressed chunks
+OUTPUT_CHUNK_SIZE = 1024 * 1024
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+
+class CorruptFile(ConnectionError):
+    """ A downloaded file failed verification, retried like an interrupted transfer but from its first byte """
+
+
+def check_nifti_header(header, size):
+    """
+    :param header: the first bytes of an uncompressed NIfTI file, at least NIFTI2_HEADER_SIZE if the file is as long
+    :param size: size of the uncompressed file
+    :return: None if the header is valid, otherwise what is wrong with it
+    """
+    if len(header) < 4:
+        return 'no NIfTI header'
+    for endian in '<>':
+        sizeof_hdr = struct.unpack(endian + 'i', header[:4])[0]
+        if sizeof_hdr == NIFTI1_HEADER_SIZE:
+            if len(header) < NIFTI1_HEADER_SIZE:
+                return 'truncated NIfTI-1 header'
+            if header[344:348] not in (b'n+1\0', b'ni1\0'):
+                return 'no NIfTI-1 magic'
+            dim = struct.unpack(endian + '8h', header[40:56])
+            bitpix = struct.unpack(endian + 'h', header[72:74])[0]
+            vox_offset = int(struct.unpack(endian + 'f', header[108:112])[0])
+            single_file = header[344:348] == b'n+1\0'
+        elif sizeof_hdr == NIFTI2_HEADER_SIZE:
+            if len(header) < NIFTI2_HEADER_SIZE:
+                return 'truncated NIfTI-2 header'
+            if header[4:8] not in (b'n+2\0', b'ni2\0'):
+                return 'no NIfTI-2 magic'
+            bitpix = struct.unpack(endian + 'h', header[14:16])[0]
+            dim = struct.unpack(endian + '8q', header[16:80])
+            vox_offset = struct.unpack(endian + 'q', header[168:176])[0]
+            single_file = header[4:8] == b'n+2\0'
+        else:
+            continue
+        if not 1 <= dim[0] <= 7:
+            return 'invalid number of dimensions {}'.format(dim[0])
+        if not single_file:
+            # Header only, the image is in a separate .img file
+            return None
+        voxels = 1
+        for extent in dim[1:dim[0] + 1]:
+            voxels *= max(extent, 1)
+        expected = vox_offset + voxels * bitpix // 8
+        if size < expected:
+            return 'image data ends at byte {} of {}'.format(size, expected)
+        return None
+    return 'no NIfTI header'
+
+
+class GzipVerifier:
+    """
+    Decompresses a gzip stream incrementally, fed like a hashlib object through update().
+    Concatenated gzip members (as written by bgzip or pigz) are supported.
+    """
+
+    def __init__(self, name, output=None, nifti=False):
+        """
+        :param name: file name for error messages
+        :param output: sink writer receiving the uncompressed bytes, committed by commit()
+        :param nifti: check the NIfTI header of the uncompressed file
+        """
+        self.name = name
+        self.output = output
+        self.nifti = nifti
+        self.decompressor = zlib.decompressobj(wbits=31)
+        # Whether the current member received input, and how many members ended
+        self.started = False
+        self.members = 0
+        self.header = b''
+        self.size = 0
+
+    def update(self, data):
+        while data:
+            self.started = True
+            try:
+                out = self.decompressor.decompress(data, OUTPUT_CHUNK_SIZE)
+            except zlib.error as e:
+                raise CorruptFile('{} is not a valid gzip file: {}'.format(self.name, e)) from e
+            if out:
+                self._uncompressed(out)
+            if self.decompressor.eof:
+                # The member's CRC-32 and length matched, anything after it is the next member
+                self.members += 1
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(wbits=31)
+                self.started = False
+            else:
+                data = self.decompressor.unconsumed_tail
+
+    def _uncompressed(self, data):
+        self.size += len(data)
+        if self.nifti and len(self.header) < NIFTI2_HEADER_SIZE:
+            self.header += data[:NIFTI2_HEADER_SIZE - len(self.header)]
+        if self.output is not None:
+            self.output.write(data)
+
+    def finish(self):
+        """ Raises CorruptFile unless the whole stream was received intact """
+        if self.started or not self.members:
+            raise CorruptFile('{} is truncated, its gzip stream ends after {} uncompressed bytes'.format(
+                self.name, self.size))
+        if self.nifti:
+            problem = check_nifti_header(self.header, self.size)
+            if problem:
+                raise CorruptFile('{} is not a valid NIfTI file: {}'.format(self.name, problem))
+
+    def commit(self):
+        """ Commits the uncompressed copy, called once the compressed file itself was written """
+        if self.output is not None:
+            self.output.commit()
+
+    def abort(self):
+        if self.output is not None:
+            self.output.abort()
@@ -0,0 +1,86 @@
+"""
+Counters shared by all download workers.
+"""
+
+import threading
+from timeit import default_timer
+
+from src.utils import human_size, human_time
+
+
+class TransferMetrics:
+    """ Thread safe totals for a download run """
+
+    def __init__(self, buffer_pool=None):
+        self.buffer_pool = buffer_pool
+        self.lock = threading.Lock()
+        self.start_time = default_timer()
+        self.files = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+
+    def add_file(self, nbytes):
+        with self.lock:
+            self.files += 1
+            self.bytes += nbytes
+
+    def add_skipped(self):
+        with self.lock:
+            self.skipped += 1
+
+    def add_failed(self):
+        with self.lock:
+            self.failed += 1
+
+    def summary(self):
+        elapsed = default_timer() - self.start_time
+        lines = [
+            'Downloaded {} files ({}) in {}, {} skipped, {} failed'.format(
+                self.files, human_size(self.bytes), human_time(int(elapsed)), self.skipped, self.failed),
+            '  Throughput: {}/s'.format(human_size(self.bytes / elapsed if elapsed else 0)),
+        ]
+        if self.buffer_pool is not None:
+            lines.append('  Chunk buffer size: {}, peak buffer memory: {} ({} buffers)'.format(
+                human_size(self.buffer_pool.buffer_size), human_size(self.buffer_pool.peak_bytes),
+                self.buffer_pool.allocated))
+        return '\n'.join(lines)
+
+
+class BatchedLog:
+    """
+    Logs completed small files as one line per batch instead of one line per file
+    """
+
+    def __init__(self, logger, batch_size=1000, interval=10):
+        """
+        :param batch_size: log once this many files completed
+        :param interval: or once this many seconds passed since the last line
+        """
+        self.logger = logger
+        self.batch_size = batch_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.last = None
+        self.logged_at = default_timer()
+
+    def add(self, location, nbytes):
+        with self.lock:
+            self.files += 1
+            self.bytes += nbytes
+            self.last = location
+            if self.files < self.batch_size and default_timer() - self.logged_at < self.interval:
+                return
+            files, size, last = self.files, self.bytes, self.last
+            self.files = self.bytes = 0
+            self.logged_at = default_timer()
+        self.logger.info('Completed {} small files ({}), last: {}'.format(files, human_size(size), last))
+
+    def flush(self):
+        with self.lock:
+            files, size, last = self.files, self.bytes, self.last
+            self.files = self.bytes = 0
+        if files:
+            self.logger.info('Completed {} small files ({}), last: {}'.format(files, human_size(size), last))
@@ -0,0 +1,195 @@
+"""
+Export of resolved download plans for external transfer tools.
+
+`download.py export-plan` resolves the selection into package files and
+presigned URLs exactly like a download, but instead of fetching the files it
+streams one entry per file into segment files in the plan directory:
+  aria2   aria2c --input-file format (URL, then indented out= and dir= options)
+  tsv     presigned URL and target path separated by a tab
+  jsonl   one JSON object per file with all its fields
+Presigned URLs expire, so a new segment is started every ``segment_minutes``
+and every segment is named after the time its first URL expires. Hand the
+segments to the external tool in order and export again for whatever was not
+transferred before its segment expired; files that are already in the
+output are skipped.
+
+Next to the segments ``index.jsonl`` lists every exported file without its
+URL. `download.py import-completed` reads it and records the files the
+external tool finished as completed downloads, moving them into the output
+when it is not a plain directory (bundles or object storage).
+"""
+
+import datetime
+import json
+import logging
+import os
+import shutil
+import time
+
+logger = logging.getLogger(__name__)
+
+PLAN_FORMATS = ('aria2', 'tsv', 'jsonl')
+EXTENSIONS = {'aria2': 'txt', 'tsv': 'tsv', 'jsonl': 'jsonl'}
+INDEX_FILE = 'index.jsonl'
+# aria2c keeps a control file next to every file it has not finished yet
+ARIA2_CONTROL_SUFFIX = '.aria2'
+
+
+def _timestamp(seconds):
+    return datetime.datetime.fromtimestamp(seconds, datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+class PlanWriter:
+    """ Streams resolved package files into time-bounded segment files """
+
+    def __init__(self, plan_dir, fmt='aria2', staging=None, segment_minutes=60, url_lifetime=24):
+        """
+        :param plan_dir: directory receiving the segments and the index
+        :param fmt: one of PLAN_FORMATS
+        :param staging: directory the external tool writes the files to
+        :param segment_minutes: how long URLs are added to the same segment
+        :param url_lifetime: hours a presigned URL stays valid
+        """
+        if fmt not in PLAN_FORMATS:
+            raise ValueError('Invalid plan format: {}'.format(fmt))
+        self.plan_dir = plan_dir
+        self.fmt = fmt
+        self.staging = os.path.abspath(staging or os.path.join(plan_dir, 'staging'))
+        self.segment_seconds = segment_minutes * 60
+        self.url_lifetime = url_lifetime * 3600
+        self.segment = None
+        self.segment_fp = None
+        self.segment_started = None
+        self.segments = []
+        self.files = 0
+        os.makedirs(plan_dir, exist_ok=True)
+        self.index_fp = open(os.path.join(plan_dir, INDEX_FILE), 'a')
+
+    def _rotate(self, now):
+        self._close_segment()
+        self.segment_started = now
+        self.segment = 'plan-{:04d}-expires-{}.{}'.format(
+            len(self.segments) + 1, _timestamp(now + self.url_lifetime), EXTENSIONS[self.fmt])
+        self.segment_fp = open(os.path.join(self.plan_dir, self.segment), 'w')
+        self.segments.append(self.segment)
+        if self.fmt == 'aria2':
+            self.segment_fp.write('# Presigned URLs in this file expire at {}\n'.format(
+                _timestamp(now + self.url_lifetime)))
+
+    def _close_segment(self):
+        if self.segment_fp is not None:
+            self.segment_fp.close()
+            self.segment_fp = None
+            logger.info('Wrote {}'.format(os.path.join(self.plan_dir, self.segment)))
+
+    def write(self, package_file, url):
+        """
+        :param package_file: PackageFile
+        :param url: its presigned URL
+        """
+        now = time.time()
+        if self.segment_fp is None or now - self.segment_started >= self.segment_seconds:
+            self._rotate(now)
+        path = os.path.join(self.staging, package_file.alias.lstrip('/'))
+        if self.fmt == 'aria2':
+            self.segment_fp.write('{}\n  dir={}\n  out={}\n'.format(url, self.staging, package_file.alias.lstrip('/')))
+        elif self.fmt == 'tsv':
+            self.segment_fp.write('{}\t{}\n'.format(url, path))
+        else:
+            self.segment_fp.write(json.dumps({
+                'package_id': package_file.package_id, 'package_file_id': package_file.package_file_id,
+                'alias': package_file.alias, 'size': package_file.size, 'url': url, 'path': path,
+                'expires': _timestamp(self.segment_started + self.url_lifetime)}) + '\n')
+        self.index_fp.write(json.dumps({
+            'package_id': package_file.package_id, 'package_file_id': package_file.package_file_id,
+            'alias': package_file.alias, 'size': package_file.size, 'path': path,
+            'segment': self.segment}) + '\n')
+        self.files += 1
+
+    def close(self):
+        self._close_segment()
+        self.index_fp.close()
+
+
+def export_plan(downloader, args):
+    """
+    Writes the downloader's resolved selection to the plan directory
+    :param downloader: Downloader created with autostart=False
+    :param args: argparse namespace, uses plan_dir, plan_format, staging, segment_minutes and url_lifetime
+    :return: (segment file names, number of exported files, number of files already in the output)
+    """
+    sink = downloader.sink
+    # Files in a plain output directory are written in place by the external tool
+    staging = getattr(args, 'staging', None) or getattr(sink, 'root', None)
+    writer = PlanWriter(args.plan_dir, getattr(args, 'plan_format', None) or 'aria2', staging,
+                        segment_minutes=getattr(args, 'segment_minutes', None) or 60,
+                        url_lifetime=getattr(args, 'url_lifetime', None) or 24)
+    skipped = 0
+    try:
+        for package_file_list in downloader.plan(make_directories=False):
+            for package_file in package_file_list:
+                if is_done(sink, package_file.alias, package_file.size):
+                    skipped += 1
+                else:
+                    writer.write(package_file, downloader.files.url(package_file.package_file_id))
+                downloader.files.release(package_file.package_file_id)
+    finally:
+        writer.close()
+    return writer.segments, writer.files, skipped
+
+
+def read_index(plan_dir):
+    """ :return: dict of alias to the last index entry exported for it """
+    entries = {}
+    with open(os.path.join(plan_dir, INDEX_FILE)) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry['alias']] = entry
+    return entries
+
+
+def is_finished(path, size=None):
+    """ True if the external tool has finished writing ``path`` """
+    if not os.path.isfile(path) or os.path.exists(path + ARIA2_CONTROL_SUFFIX):
+        return False
+    return size is None or os.path.getsize(path) == size
+
+
+def is_done(sink, alias, size=None):
+    """ True if ``alias`` is already in the sink or was finished in place in the output directory """
+    return sink.contains(alias, size) or is_finished(sink.location(alias), size)
+
+
+def import_completed(sink, plan_dir, buffer_size=1024 * 1024 * 5):
+    """
+    Records the files of an exported plan that the external tool finished.
+    Files staged outside the sink are copied into it and removed from the staging directory.
+    :param sink: output Sink
+    :param plan_dir: directory written by export_plan()
+    :return: generator of (index entry, status), status is one of 'completed', 'skipped' or 'missing'
+    """
+    for alias, entry in read_index(plan_dir).items():
+        path, size = entry['path'], entry['size']
+        in_place = os.path.abspath(sink.location(alias)) == os.path.abspath(path)
+        if not in_place and sink.contains(alias, size):
+            yield entry, 'skipped'
+            continue
+        if not is_finished(path, size):
+            yield entry, 'missing'
+            continue
+        if not in_place:
+            writer = sink.open(alias, size)
+            try:
+                if writer.offset:
+                    writer.restart()
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, writer, buffer_size)
+            except BaseException:
+                writer.abort()
+                raise
+            writer.commit()
+            os.remove(path)
+        yield entry, 'completed'
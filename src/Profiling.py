@@ -0,0 +1,173 @@
+"""
+Profiling of download runs.
+
+With --profile every stage of a run is recorded as a timed span: reading the
+manifests, the /files lookups, presigning, creating directories and, per
+file, the request (connection, TLS handshake and waiting for the response
+headers), the body transfer, the writes into the sink and the commit. The
+spans are written as a Chrome trace (open it in chrome://tracing or
+https://ui.perfetto.dev) and totals per stage are logged as a table of the
+top time sinks.
+
+Recording a span costs two clock reads and a list append, so profiling can be
+left on for production runs; past ``max_events`` spans only the totals are
+kept. Optionally a sampling profiler takes the stacks of all threads every
+few milliseconds and writes them as folded stacks for flamegraph.pl or
+speedscope.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from src.utils import human_time
+
+MAX_EVENTS = 1000000
+
+
+class Profiler:
+    """ Collects spans from all threads """
+
+    def __init__(self, path, max_events=MAX_EVENTS, sample_interval=None):
+        """
+        :param path: Chrome trace file written by close()
+        :param max_events: spans kept for the trace, totals are always kept
+        :param sample_interval: seconds between stack samples, None disables sampling
+        """
+        self.path = path
+        self.max_events = max_events
+        self.start = time.perf_counter()
+        self.events = []
+        self.totals = Counter()
+        self.counts = Counter()
+        self.lock = threading.Lock()
+        self.sampler = StackSampler(sample_interval) if sample_interval else None
+        if self.sampler is not None:
+            self.sampler.start()
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add(name, start, time.perf_counter() - start, args)
+
+    def add(self, name, start, duration, args=None):
+        """
+        Records a span that was timed by the caller
+        :param start: perf_counter() value at the start of the span
+        :param duration: seconds
+        """
+        with self.lock:
+            self.totals[name] += duration
+            self.counts[name] += 1
+            if len(self.events) < self.max_events:
+                self.events.append((name, threading.get_ident(), start, duration, args))
+
+    def trace(self):
+        """ The spans in Chrome trace event format """
+        pid = os.getpid()
+        thread_ids = {}
+        events = []
+        for name, thread, start, duration, args in self.events:
+            tid = thread_ids.setdefault(thread, len(thread_ids))
+            event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                     'ts': (start - self.start) * 1e6, 'dur': duration * 1e6}
+            if args:
+                event['args'] = args
+            events.append(event)
+        for thread, tid in thread_ids.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                           'args': {'name': 'thread {}'.format(tid)}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def summary(self, top=15):
+        elapsed = time.perf_counter() - self.start
+        lines = ['Profile ({} wall time, totals summed over all threads):'.format(human_time(int(elapsed))),
+                 '  {:<24} {:>10} {:>12} {:>12} {:>12}'.format('Stage', 'Count', 'Total s', 'Mean ms', '% of wall')]
+        for name, total in self.totals.most_common(top):
+            count = self.counts[name]
+            lines.append('  {:<24} {:>10} {:>12.2f} {:>12.2f} {:>11.1f}%'.format(
+                name, count, total, total / count * 1000, total / elapsed * 100 if elapsed else 0))
+        if len(self.events) >= self.max_events:
+            lines.append('  Trace truncated after {} spans, totals include all spans'.format(self.max_events))
+        return '\n'.join(lines)
+
+    def close(self):
+        """ Writes the trace, and the sampled stacks if any, and returns the summary """
+        if self.sampler is not None:
+            self.sampler.stop()
+            self.sampler.write(os.path.splitext(self.path)[0] + '.folded')
+        with self.lock:
+            trace = self.trace()
+        with open(self.path, 'w') as f:
+            json.dump(trace, f)
+        return self.summary()
+
+
+class NullProfiler:
+    """ Used when profiling is off, every span is a no-op """
+
+    path = None
+
+    @contextmanager
+    def span(self, name, **args):
+        yield args
+
+    def add(self, name, start, duration, args=None):
+        pass
+
+    def close(self):
+        return None
+
+
+class StackSampler(threading.Thread):
+    """ Counts the stacks of all other threads every ``interval`` seconds """
+
+    def __init__(self, interval=0.01):
+        threading.Thread.__init__(self)
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.daemon = True
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            for thread, frame in sys._current_frames().items():
+                if thread == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno))
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self, path):
+        """ Folded stacks, one 'frame;frame;frame count' line per distinct stack """
+        with open(path, 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write('{} {}\n'.format(stack, count))
+
+
+def get_profiler(args):
+    """
+    :param args: argparse namespace, uses profile (trace file) and profile_sample (ms)
+    :return: Profiler, or NullProfiler without --profile
+    """
+    path = getattr(args, 'profile', None)
+    if not path:
+        return NullProfiler()
+    sample = getattr(args, 'profile_sample', None)
+    return Profiler(path, sample_interval=sample / 1000 if sample else None)
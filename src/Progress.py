@@ -0,0 +1,326 @@
+"""
+Progress and ETA of a download run.
+
+RunProgress keeps running totals for the whole run, for every data subset
+(the basename of the manifest rows that selected a file) and for every
+subject: files selected, files resolved through the /files endpoint and their
+bytes, files completed, skipped and failed. Every update touches three
+counters under one lock, so workers pay the same constant cost per file
+whatever the size of the run.
+
+Files are resolved batch by batch while the download runs, so the size of
+the files not resolved yet is estimated from the mean size of the resolved
+files of the same subset. The current rate is a moving average over the
+save intervals and the ETA is the estimated remaining bytes at that rate.
+
+Every ``interval`` seconds the totals are logged in one line and saved to a
+small JSON status file (by default ``.download-status.json`` in the output
+folder), which `download.py status` reads, so a run can be checked from any
+process or node that sees the file.
+"""
+
+import datetime
+import json
+import logging
+import os
+import re
+import socket
+import threading
+from timeit import default_timer
+
+from src.Selection import MANIFEST_SUFFIX
+from src.utils import human_size, human_time
+
+logger = logging.getLogger(__name__)
+
+STATUS_FILE = '.download-status.json'
+DEFAULT_INTERVAL = 60
+# Weight of the latest interval in the moving average of the rate
+RATE_SMOOTHING = 0.2
+SUBJECT_RE = re.compile(r'sub-[^/_.]+')
+
+
+def subject_of(alias):
+    match = SUBJECT_RE.search(alias)
+    return match.group(0) if match else None
+
+
+class Totals:
+    """ Counters of one group of files """
+
+    __slots__ = ('selected', 'resolved', 'resolved_bytes', 'files', 'skipped', 'failed', 'bytes', 'settled_bytes')
+
+    def __init__(self):
+        self.selected = 0
+        self.resolved = 0
+        # Sizes from the package metadata, of all resolved files and of the finished ones
+        self.resolved_bytes = 0
+        self.settled_bytes = 0
+        self.files = 0
+        self.skipped = 0
+        self.failed = 0
+        # Bytes actually downloaded
+        self.bytes = 0
+
+    def remaining_files(self):
+        return max(0, self.selected - self.files - self.skipped - self.failed)
+
+    def remaining_bytes(self):
+        """ Bytes of the resolved files not finished yet, plus an estimate for the unresolved ones """
+        remaining = self.resolved_bytes - self.settled_bytes
+        if self.resolved and self.selected > self.resolved:
+            remaining += (self.selected - self.resolved) * self.resolved_bytes / self.resolved
+        return max(0, int(remaining))
+
+    def as_dict(self):
+        return {'selected': self.selected, 'resolved': self.resolved, 'files': self.files,
+                'skipped': self.skipped, 'failed': self.failed, 'bytes': self.bytes,
+                'remaining_files': self.remaining_files(), 'remaining_bytes': self.remaining_bytes()}
+
+
+class RunProgress:
+    """ Running totals of a download run, logged and saved to a status file periodically """
+
+    def __init__(self, path=None, interval=DEFAULT_INTERVAL, output=None, log=logger):
+        """
+        :param path: status file, None to only log the progress
+        :param interval: seconds between saves
+        :param output: output folder or URL of the run, recorded in the status file
+        :param log: logger the progress line is logged to every interval
+        """
+        self.log = log
+        self.path = path
+        self.interval = interval
+        self.output = output
+        self.lock = threading.Lock()
+        self.total = Totals()
+        self.subsets = {}
+        self.subjects = {}
+        self.names = {}
+        self.started = datetime.datetime.now()
+        self.start_time = default_timer()
+        self.rate = None
+        self.sampled_at = self.start_time
+        self.sampled_bytes = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _groups(self, subset, subject):
+        groups = [self.total]
+        if subset is not None:
+            groups.append(self.subsets.get(subset) or self.subsets.setdefault(subset, Totals()))
+        if subject is not None:
+            groups.append(self.subjects.get(subject) or self.subjects.setdefault(subject, Totals()))
+        return groups
+
+    def select(self, manifest_name):
+        """
+        Counts a selected manifest row
+        :param manifest_name: ${SUBJECT}.${BASENAME}.manifest.json
+        :return: the row's subset, the same string object for every row of the subset
+        """
+        subset = manifest_name.partition('.')[2]
+        if subset.endswith(MANIFEST_SUFFIX):
+            subset = subset[:-len(MANIFEST_SUFFIX)]
+        with self.lock:
+            # One copy of every subset name is kept for all the files of the subset
+            subset = self.names.setdefault(subset, subset)
+            for totals in self._groups(subset, subject_of(manifest_name)):
+                totals.selected += 1
+        return subset
+
+    def resolve(self, package_files, links, subsets):
+        """
+        Counts the sizes of a batch of package files and tags every file with its subset
+        :param package_files: PackageFile results of the /files lookup of ``links``
+        :param links: S3 links of the batch
+        :param subsets: subset of every link, as returned by select()
+        """
+        # s3://bucket/submission_N/<download alias>
+        by_alias = {link.split('/', 4)[-1]: subset for link, subset in zip(links, subsets)}
+        with self.lock:
+            for package_file in package_files:
+                alias = package_file.alias.lstrip('/')
+                subset = by_alias.get(alias)
+                if subset is None:
+                    subset = next((s for link, s in zip(links, subsets) if link.endswith('/' + alias)), None)
+                package_file.subset = subset
+                for totals in self._groups(subset, subject_of(alias)):
+                    totals.resolved += 1
+                    totals.resolved_bytes += package_file.size or 0
+
+    def finished(self, package_file, record):
+        """ Counts a handled file, cancelled files stay remaining """
+        if package_file is None or record.status == 'cancelled':
+            return
+        with self.lock:
+            for totals in self._groups(package_file.subset, subject_of(package_file.alias)):
+                totals.settled_bytes += package_file.size or 0
+                if record.status == 'completed':
+                    totals.files += 1
+                    totals.bytes += record.bytes or 0
+                elif record.status == 'skipped':
+                    totals.skipped += 1
+                else:
+                    totals.failed += 1
+
+    def sample_rate(self):
+        """ Updates the moving average of the download rate with the bytes since the last sample """
+        now = default_timer()
+        with self.lock:
+            downloaded = self.total.bytes
+        elapsed = now - self.sampled_at
+        if elapsed <= 0:
+            return
+        rate = (downloaded - self.sampled_bytes) / elapsed
+        self.rate = rate if self.rate is None else RATE_SMOOTHING * rate + (1 - RATE_SMOOTHING) * self.rate
+        self.sampled_at = now
+        self.sampled_bytes = downloaded
+
+    def status(self, state='running'):
+        """ The totals as saved to the status file """
+        elapsed = default_timer() - self.start_time
+        with self.lock:
+            total = self.total.as_dict()
+            subsets = {name: totals.as_dict() for name, totals in self.subsets.items()}
+            subjects = {name: totals.as_dict() for name, totals in self.subjects.items()}
+        rate = self.rate or 0
+        return {
+            'state': state,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'output': self.output,
+            'started': self.started.isoformat(timespec='seconds'),
+            'updated': datetime.datetime.now().isoformat(timespec='seconds'),
+            'interval': self.interval,
+            'elapsed': int(elapsed),
+            'rate': rate,
+            'average_rate': total['bytes'] / elapsed if elapsed else 0,
+            'eta': int(total['remaining_bytes'] / rate) if rate and state == 'running' else None,
+            'total': total,
+            'subsets': subsets,
+            'subjects': subjects,
+        }
+
+    def save(self, state='running'):
+        status = self.status(state)
+        self.log.info(summary_line(status))
+        if self.path is None:
+            return
+        temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(temporary, 'w') as f:
+                json.dump(status, f)
+            # Readers never see a partially written file
+            os.replace(temporary, self.path)
+        except OSError as e:
+            self.log.info('Could not save the status file {}: {}'.format(self.path, e))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample_rate()
+            self.save()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='progress', daemon=True)
+        self.thread.start()
+
+    def close(self, state='finished'):
+        """ Stops the periodic saves and saves the final totals """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.sample_rate()
+        self.save(state)
+
+
+class NullProgress:
+    """ Used in worker processes, the coordinating process keeps the totals """
+
+    def select(self, manifest_name):
+        return None
+
+    def resolve(self, package_files, links, subsets):
+        pass
+
+    def finished(self, package_file, record):
+        pass
+
+    def start(self):
+        pass
+
+    def close(self, state='finished'):
+        pass
+
+
+def status_path(args):
+    """ The status file of a run, None for object storage output without --status-file """
+    path = getattr(args, 'status_file', None)
+    if path:
+        return path
+    output = getattr(args, 'output', None)
+    if not output or output.startswith('s3://'):
+        return None
+    return os.path.join(output, STATUS_FILE)
+
+
+def get_progress(args, log=logger):
+    """
+    :param args: argparse namespace, uses status_file, status_interval and output
+    :param log: logger the progress line is logged to
+    :return: RunProgress
+    """
+    return RunProgress(status_path(args), getattr(args, 'status_interval', None) or DEFAULT_INTERVAL,
+                       getattr(args, 'output', None), log)
+
+
+def summary_line(status):
+    total = status['total']
+    eta = status.get('eta')
+    return 'Progress: {} of {} files, {} done, ~{} remaining, {}/s{}'.format(
+        total['files'] + total['skipped'] + total['failed'], total['selected'], human_size(total['bytes']),
+        human_size(total['remaining_bytes']), human_size(status['rate']),
+        ', ETA {}'.format(human_time(eta)) if eta is not None else '')
+
+
+def format_status(status, top=10):
+    """
+    Human readable report of a status file
+    :param top: number of subsets and incomplete subjects listed
+    """
+    total = status['total']
+    updated = datetime.datetime.fromisoformat(status['updated'])
+    age = int((datetime.datetime.now() - updated).total_seconds())
+    state = status['state']
+    if state == 'running' and age > 3 * status['interval']:
+        state = 'running, but not updated for {} (the run may have stopped)'.format(human_time(age))
+    lines = [
+        'Run on {} (pid {}) writing to {}: {}'.format(status['host'], status['pid'], status['output'], state),
+        '  Started {}, updated {} ago'.format(status['started'], human_time(max(age, 0))),
+        '  Files: {} completed, {} skipped, {} failed, {} of {} remaining'.format(
+            total['files'], total['skipped'], total['failed'], total['remaining_files'], total['selected']),
+        '  Data: {} downloaded, ~{} remaining'.format(human_size(total['bytes']), human_size(total['remaining_bytes'])),
+        '  Rate: {}/s (average {}/s){}'.format(
+            human_size(status['rate']), human_size(status['average_rate']),
+            ', ETA {}'.format(human_time(status['eta'])) if status.get('eta') is not None else ''),
+    ]
+    subsets = sorted(status['subsets'].items(), key=lambda item: -item[1]['remaining_bytes'])
+    if subsets:
+        lines.append('  {:<60} {:>12} {:>12} {:>8}'.format('Subset (most remaining first)', 'Files', 'Remaining', 'Failed'))
+        for name, totals in subsets[:top]:
+            lines.append('  {:<60} {:>12} {:>12} {:>8}'.format(
+                name, '{}/{}'.format(totals['files'] + totals['skipped'], totals['selected']),
+                human_size(totals['remaining_bytes']), totals['failed']))
+    subjects = status['subjects']
+    incomplete = sorted((name for name, totals in subjects.items() if totals['remaining_files'] or totals['failed']),
+                        key=lambda name: -subjects[name]['remaining_files'])
+    lines.append('  Subjects: {} of {} complete'.format(len(subjects) - len(incomplete), len(subjects)))
+    for name in incomplete[:top]:
+        totals = subjects[name]
+        lines.append('    {:<40} {} files remaining, {} failed'.format(name, totals['remaining_files'], totals['failed']))
+    return '\n'.join(lines)
+
+
+def read_status(path):
+    with open(path) as f:
+        return json.load(f)
@@ -0,0 +1,119 @@
+"""
+Selection of manifest rows by basename, subject and session.
+
+Lines of a basenames file (e.g. data_subsets.txt) can be
+  - exact basenames:   derivatives.func.runs_task-rest_bold
+  - glob patterns:     derivatives.func.*task-rest*
+  - regular expressions, prefixed with re:   re:derivatives\\.(anat|func)\\..*
+Exact basenames are looked up in a set and all patterns are compiled into a
+single regular expression, so every manifest_name is matched once no matter
+how many lines the file has.
+"""
+
+import fnmatch
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_SUFFIX = '.manifest.json'
+SESSION_RE = re.compile(r'ses-[^._]+')
+GLOB_CHARS = set('*?[')
+
+
+def read_lines(path):
+    """ Non-empty lines of a text file, ignoring # comments """
+    with open(path) as f:
+        lines = [line.split('#', 1)[0].strip() for line in f]
+    return [line for line in lines if line]
+
+
+def _to_regex(pattern):
+    if pattern.startswith('re:'):
+        return pattern[3:]
+    return fnmatch.translate(pattern)
+
+
+class SubsetMatcher:
+    """ Decides in one pass which manifest names are selected """
+
+    def __init__(self, basenames, subjects=None, sessions=None):
+        """
+        :param basenames: exact basenames, glob patterns or re: prefixed regular expressions
+        :param subjects: subject IDs to keep, or None for all subjects
+        :param sessions: glob patterns of session labels to keep, or None for all sessions
+        """
+        self.patterns = list(dict.fromkeys(basenames))
+        self.counts = dict.fromkeys(self.patterns, 0)
+        self.exact = {p for p in self.patterns if not p.startswith('re:') and not GLOB_CHARS & set(p)}
+        self.group_patterns = {}
+        alternatives = []
+        for pattern in self.patterns:
+            if pattern in self.exact:
+                continue
+            group = 'p{}'.format(len(alternatives))
+            self.group_patterns[group] = pattern
+            alternatives.append('(?P<{}>{})'.format(group, _to_regex(pattern)))
+        self.regex = re.compile('(?:{})\\Z'.format('|'.join(alternatives))) if alternatives else None
+        self.subjects = set(subjects) if subjects is not None else None
+        self.sessions = re.compile('(?:{})\\Z'.format('|'.join(_to_regex(s) for s in sessions))) if sessions else None
+        self.rows = 0
+
+    @classmethod
+    def from_args(cls, args):
+        subject_list_file = getattr(args, 'subject_list_file', None)
+        return cls(read_lines(args.basenames_file),
+                   subjects=read_lines(subject_list_file) if subject_list_file else None,
+                   sessions=getattr(args, 'sessions', None))
+
+    def match(self, manifest_name):
+        """
+        :param manifest_name: ${SUBJECT}.${BASENAME}.manifest.json
+        :return: the basename line that selected the row, or None
+        """
+        self.rows += 1
+        subject, _, basename = manifest_name.partition('.')
+        if self.subjects is not None and subject not in self.subjects \
+                and subject.split('_', 1)[0] not in self.subjects:
+            return None
+        if self.sessions is not None:
+            session = SESSION_RE.search(manifest_name)
+            if not session or not self.sessions.match(session.group(0)):
+                return None
+        if basename.endswith(MANIFEST_SUFFIX):
+            basename = basename[:-len(MANIFEST_SUFFIX)]
+        if basename in self.exact:
+            pattern = basename
+        elif self.regex is not None:
+            m = self.regex.match(basename)
+            if not m:
+                return None
+            pattern = self.group_patterns[m.lastgroup]
+        else:
+            return None
+        self.counts[pattern] += 1
+        return pattern
+
+    def mask(self, manifest_names):
+        """ List of booleans, True for every selected manifest name """
+        return [self.match(name) is not None for name in manifest_names]
+
+    def explain(self):
+        width = max([len(p) for p in self.patterns] + [7])
+        lines = ['{:<{w}}  {:>10}'.format('Pattern', 'Rows', w=width)]
+        for pattern in self.patterns:
+            lines.append('{:<{w}}  {:>10}'.format(pattern, self.counts[pattern], w=width))
+        lines.append('{} of {} manifest rows selected'.format(sum(self.counts.values()), self.rows))
+        return '\n'.join(lines)
+
+
+def explain_selection(args):
+    """ Prints how many manifest rows every line of the basenames file selects """
+    import pandas as pd
+
+    manifest_files = args.manifest_file if isinstance(args.manifest_file, (list, tuple)) else [args.manifest_file]
+    matcher = SubsetMatcher.from_args(args)
+    for manifest_file in manifest_files:
+        manifest = pd.read_csv(manifest_file, sep='\t', usecols=['manifest_name'])
+        matcher.mask(manifest['manifest_name'].values)
+    print(matcher.explain())
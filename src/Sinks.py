@@ -0,0 +1,444 @@
+"""
+Output sinks for downloaded files.
+
+A sink decides where the bytes of each download alias end up.  Every sink
+hands out one writer per file; the download loop streams chunks into the
+writer and then calls commit() on success or abort() on failure, so no sink
+ever needs more than one chunk (or one multipart part) in memory per file.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import sys
+import threading
+from collections import namedtuple
+
+from src.Bundle import BundleSet
+from src.PlanExport import is_finished
+from src.utils import deconstruct_s3_url
+
+logger = logging.getLogger(__name__)
+
+# S3 requires every part of a multipart upload except the last to be >= 5MB
+MIN_PART_SIZE = 1024 * 1024 * 5
+DEFAULT_PART_SIZE = 1024 * 1024 * 64
+
+DURABILITY_POLICIES = ('none', 'fsync', 'fsync-dir')
+# Number of directories collected before they are fsynced with the fsync-dir policy
+DIR_SYNC_BATCH = 256
+DEFAULT_STRIPE_SIZE = 1024 * 1024
+
+WrittenFile = namedtuple('WrittenFile', ['location', 'size'])
+
+
+class Sink:
+    """ Base class for output sinks """
+
+    def contains(self, alias, size=None):
+        """
+        Returns True if the alias has already been written and can be skipped
+        :param alias: download alias of a package file
+        :param size: expected size in bytes if known
+        """
+        return False
+
+    def location(self, alias):
+        """ Where ``alias`` is written, for logs and completion records """
+        return alias
+
+    def plan_directories(self, aliases):
+        """
+        Returns the directories that have to exist before ``aliases`` can be
+        written. Each directory is only returned once per run.
+        """
+        return []
+
+    def make_directory(self, directory):
+        pass
+
+    def directories_made(self, aliases):
+        """ Records that the directories of ``aliases`` were created elsewhere, e.g. by the coordinating process """
+        pass
+
+    def open(self, alias, size=None):
+        raise NotImplementedError
+
+    def put(self, alias, data):
+        """
+        Writes a small file that was received completely in memory
+        :return: object with the ``location`` and ``size`` of the written file
+        """
+        writer = self.open(alias, len(data))
+        try:
+            if writer.offset:
+                writer.restart()
+            writer.write(data)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.commit()
+        return writer
+
+    def close(self):
+        pass
+
+
+class LocalFileWriter:
+
+    def __init__(self, sink, completed, size=None):
+        self.sink = sink
+        self.location = completed
+        self.partial = completed + '.partial'
+        # Bytes already downloaded by an earlier attempt
+        self.offset = 0
+        if os.path.isfile(self.partial):
+            existing = os.path.getsize(self.partial)
+            # Preallocation keeps the file size, so a shorter .partial holds exactly
+            # the bytes received before the interruption. One that is not shorter
+            # than the file cannot be resumed and is downloaded again.
+            if size is None or existing < size:
+                self.offset = existing
+        else:
+            sink.ensure_directory(os.path.dirname(self.partial))
+        # Unbuffered so chunks are written straight from the worker's buffer
+        self.fp = open(self.partial, 'r+b' if self.offset else 'wb', buffering=0)
+        self.fp.seek(self.offset)
+        self.size = self.offset
+        if size and sink.preallocate:
+            preallocate(self.fp.fileno(), size)
+
+    def hash_prefix(self, hasher, buffer):
+        """ Feeds the bytes kept from earlier attempts to ``hasher`` """
+        with open(self.partial, 'rb', buffering=0) as f:
+            remaining = self.offset
+            while remaining:
+                n = f.readinto(buffer[:min(remaining, len(buffer))])
+                if not n:
+                    break
+                hasher.update(buffer[:n])
+                remaining -= n
+
+    def restart(self):
+        """ Discards the bytes of earlier attempts, e.g. when the server ignored a Range request """
+        self.fp.seek(0)
+        self.offset = 0
+        self.size = 0
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            n = self.fp.write(view)
+            view = view[n:]
+        self.size += len(data)
+        return len(data)
+
+    def commit(self):
+        # Drop any preallocated space beyond the bytes actually received
+        os.ftruncate(self.fp.fileno(), self.size)
+        if self.sink.durability != 'none':
+            os.fsync(self.fp.fileno())
+        self.fp.close()
+        os.rename(self.partial, self.location)
+        self.sink.renamed(os.path.dirname(self.location))
+
+    def abort(self):
+        # Keep the .partial file around so the download can be picked up again,
+        # without the preallocated tail so its size matches the bytes received
+        os.ftruncate(self.fp.fileno(), self.size)
+        self.fp.close()
+
+
+class LocalFileSink(Sink):
+    """
+    Writes every alias to its own file below the output directory (default).
+
+    Durability policies:
+      none      rely on the OS to flush data eventually (fastest, files may be
+                empty or truncated after a node failure)
+      fsync     fsync every file before it is renamed from .partial
+      fsync-dir as fsync, and additionally fsync the directories containing
+                renamed files in batches so the renames themselves survive a crash
+    """
+
+    def __init__(self, root, durability='none', preallocate=True, dir_sync_batch=DIR_SYNC_BATCH):
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError('Invalid durability policy: {}'.format(durability))
+        self.root = root
+        self.durability = durability
+        self.preallocate = preallocate
+        self.dir_sync_batch = dir_sync_batch
+        self.dirty_dirs = set()
+        self.lock = threading.Lock()
+        # Directories known to exist, so workers never have to stat or mkdir them
+        self.known_dirs = set()
+        self.planned_dirs = set()
+
+    def location(self, alias):
+        return os.path.normpath(os.path.join(self.root, alias))
+
+    def contains(self, alias, size=None):
+        # Files are only renamed to their final name once complete, except for
+        # small files and files written in place by an external tool, so the
+        # size is checked too and files aria2c is still writing are skipped
+        return is_finished(self.location(alias), size)
+
+    def plan_directories(self, aliases):
+        with self.lock:
+            needed = {os.path.dirname(self.location(alias)) for alias in aliases}
+            needed -= self.planned_dirs
+            self.planned_dirs.update(needed)
+        # makedirs creates all parents, so only the deepest new directories are needed
+        parents = set()
+        for directory in needed:
+            parent = os.path.dirname(directory)
+            while parent and parent not in parents and parent != os.path.dirname(parent):
+                parents.add(parent)
+                parent = os.path.dirname(parent)
+        return sorted(needed - parents)
+
+    def make_directory(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        added = set()
+        while directory and directory not in added and directory != os.path.dirname(directory):
+            added.add(directory)
+            directory = os.path.dirname(directory)
+        with self.lock:
+            self.known_dirs |= added
+
+    def directories_made(self, aliases):
+        directories = {os.path.dirname(self.location(alias)) for alias in aliases}
+        with self.lock:
+            self.known_dirs |= directories
+
+    def ensure_directory(self, directory):
+        # Set lookups are atomic under the GIL, no lock needed to read
+        if directory not in self.known_dirs:
+            self.make_directory(directory)
+
+    def open(self, alias, size=None):
+        return LocalFileWriter(self, self.location(alias), size)
+
+    def put(self, alias, data):
+        # A single write straight to the final name, without a .partial file to rename.
+        # Small files always have a known size, and contains() compares it with the file
+        # on disk, so a file left short by an interrupted write is downloaded again.
+        path = self.location(alias)
+        self.ensure_directory(os.path.dirname(path))
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+            if self.durability != 'none':
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.renamed(os.path.dirname(path))
+        return WrittenFile(path, len(data))
+
+    def renamed(self, directory):
+        if self.durability != 'fsync-dir':
+            return
+        with self.lock:
+            self.dirty_dirs.add(directory)
+            if len(self.dirty_dirs) < self.dir_sync_batch:
+                return
+            dirty, self.dirty_dirs = self.dirty_dirs, set()
+        fsync_directories(dirty)
+
+    def close(self):
+        with self.lock:
+            dirty, self.dirty_dirs = self.dirty_dirs, set()
+        fsync_directories(dirty)
+
+
+def _libc_fallocate():
+    """ fallocate(2) from the C library, None where it is not available """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fallocate = libc.fallocate
+    except (OSError, AttributeError):
+        return None
+    fallocate.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64)
+    fallocate.restype = ctypes.c_int
+    return fallocate
+
+
+_fallocate = _libc_fallocate()
+# Allocate the blocks without changing the size of the file
+FALLOC_FL_KEEP_SIZE = 1
+
+
+def preallocate(fd, size):
+    """
+    Reserves ``size`` bytes for a file so the filesystem can allocate it
+    contiguously instead of growing it one small append at a time. The file
+    keeps its size, so the size of a .partial left behind by a killed run is
+    still the number of bytes received and the download resumes from there.
+    Silently does nothing where fallocate is unavailable or unsupported.
+    """
+    if _fallocate is None:
+        return
+    if _fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        error = ctypes.get_errno()
+        if error not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+            raise OSError(error, os.strerror(error))
+
+
+def fsync_directories(directories):
+    for directory in directories:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def get_stripe_size(path):
+    """
+    Best guess of the preferred write size of the filesystem holding ``path``.
+    GPFS reports its block size and most other filesystems their I/O block
+    size through statvfs. Lustre stripe sizes should be passed explicitly
+    (see `lfs getstripe`).
+    :return: size in bytes
+    """
+    while path and not os.path.exists(path):
+        path = os.path.dirname(path)
+    try:
+        return os.statvfs(path or '.').f_bsize
+    except (OSError, AttributeError):
+        return DEFAULT_STRIPE_SIZE
+
+
+def align_buffer_size(buffer_size, stripe_size):
+    """ Rounds the chunk buffer size up to a whole number of stripes """
+    if not stripe_size:
+        return buffer_size
+    return max(1, -(-buffer_size // stripe_size)) * stripe_size
+
+
+class S3MultipartWriter:
+    """ Buffers at most one part in memory and uploads it as soon as it is full """
+
+    def __init__(self, client, bucket, key, part_size):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.location = 's3://{}/{}'.format(bucket, key)
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = None
+        self.offset = 0
+        self.size = 0
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=part_number, Body=bytes(self.buffer))
+        self.parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+        del self.buffer[:]
+
+    def write(self, data):
+        # Copies the chunk, the caller reuses its buffer
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def commit(self):
+        if self.upload_id is None:
+            # Small objects fit in a single request
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            del self.buffer[:]
+            return
+        if self.buffer:
+            self._upload_part()
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+
+    def abort(self):
+        del self.buffer[:]
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+class S3Sink(Sink):
+    """
+    Uploads every alias to an S3-compatible object store (AWS S3, MinIO, Ceph...)
+    without writing it to local disk. Credentials are resolved by boto3 in the
+    usual way (environment variables, ~/.aws/credentials, instance profile).
+    """
+
+    def __init__(self, s3_url, endpoint_url=None, part_size=DEFAULT_PART_SIZE):
+        import boto3
+
+        self.bucket, self.prefix = deconstruct_s3_url(s3_url)
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        # boto3 clients are thread safe, share one connection pool across workers
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+
+    def key(self, alias):
+        return '/'.join(p for p in (self.prefix.rstrip('/'), alias.lstrip('/')) if p)
+
+    def location(self, alias):
+        return 's3://{}/{}'.format(self.bucket, self.key(alias))
+
+    def contains(self, alias, size=None):
+        from botocore.exceptions import ClientError
+
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(alias))
+        except ClientError:
+            return False
+        return size is None or head['ContentLength'] == size
+
+    def open(self, alias, size=None):
+        return S3MultipartWriter(self.client, self.bucket, self.key(alias), self.part_size)
+
+
+class BundleSink(Sink):
+    """
+    Streams every alias into its subject's or session's archive, see src/Bundle.py.
+    Each file is written straight into a region reserved for it in its bundle,
+    so files of the same bundle download in parallel.
+    """
+
+    def __init__(self, root, level='subject', fmt='tar'):
+        self.bundles = BundleSet(root, level, fmt)
+
+    def contains(self, alias, size=None):
+        with self.bundles.use(alias) as bundle:
+            return bundle.contains(alias, size)
+
+    def location(self, alias):
+        return '{}:{}'.format(self.bundles.path_for(alias), alias)
+
+    def open(self, alias, size=None):
+        writer = self.bundles.open_member(alias, size)
+        writer.location = self.location(alias)
+        return writer
+
+    def close(self):
+        self.bundles.close()
+
+
+def get_sink(args):
+    """
+    Creates the output sink selected on the command line
+    :param args: argparse namespace, uses output, bundle, bundle_format, s3_endpoint_url and durability
+    :return: Sink
+    """
+    if args.output.startswith('s3://'):
+        return S3Sink(args.output, endpoint_url=getattr(args, 's3_endpoint_url', None))
+    if getattr(args, 'bundle', None):
+        return BundleSink(args.output, args.bundle, getattr(args, 'bundle_format', 'tar'))
+    return LocalFileSink(args.output, durability=getattr(args, 'durability', None) or 'none')
@@ -0,0 +1,181 @@
+"""
+Watchdog for in-flight S3 transfers.
+
+A single monitor thread looks at every running transfer once per interval
+and aborts the ones that stopped making progress:
+  - no body bytes within ``first_byte_timeout`` seconds of the request
+  - no bytes at all for ``idle_timeout`` seconds
+  - less than ``min_rate`` bytes/s averaged over the last ``window`` seconds
+  - optionally, near the end of the run, transfers much slower than the
+    other transfers still in flight (hedging)
+Aborting shuts down the transfer's socket, which makes the worker's blocking
+read fail with StalledTransfer. Reads are capped at WATCH_READ_SIZE bytes, so
+progress is reported while a large chunk buffer fills. That is retried by the retry policy, which
+resumes the download from the bytes already written.
+"""
+
+import logging
+import socket
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Largest read between two progress updates of a transfer
+WATCH_READ_SIZE = 256 * 1024
+
+
+class StalledTransfer(ConnectionError):
+    """ Raised in the worker when the watchdog aborted its transfer """
+
+
+class IncompleteTransfer(ConnectionError):
+    """ Raised when a stream ended before Content-Length bytes were received """
+
+
+class Transfer:
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.last_byte = self.started
+        self.first_byte = None
+        self.bytes = 0
+        self.samples = deque()
+        self.response = None
+        self.stalled = None
+
+    def update(self, n):
+        if n:
+            self.last_byte = time.time()
+            if self.first_byte is None:
+                self.first_byte = self.last_byte
+            self.bytes += n
+
+    def rate(self, window):
+        """ Average bytes/s over the sampled window, or None if it does not span ``window`` yet """
+        if not self.samples or self.samples[-1][0] - self.samples[0][0] < window:
+            return None
+        (t0, b0), (t1, b1) = self.samples[0], self.samples[-1]
+        return (b1 - b0) / (t1 - t0)
+
+
+class TransferMonitor(threading.Thread):
+
+    def __init__(self, first_byte_timeout=60, idle_timeout=60, min_rate=0, window=120,
+                 hedge=False, hedge_ratio=0.1, interval=1, log=logger):
+        threading.Thread.__init__(self)
+        self.log = log
+        self.first_byte_timeout = first_byte_timeout
+        self.idle_timeout = idle_timeout
+        self.min_rate = min_rate
+        self.window = window
+        self.hedge = hedge
+        self.hedge_ratio = hedge_ratio
+        self.interval = interval
+        self.transfers = set()
+        self.hedged = set()
+        self.pending = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.daemon = True
+
+    def begin(self, name):
+        transfer = Transfer(name)
+        with self.lock:
+            self.transfers.add(transfer)
+        return transfer
+
+    def attach(self, transfer, response):
+        """ Called once response headers arrived, makes the transfer abortable """
+        transfer.response = response
+
+    def end(self, transfer):
+        with self.lock:
+            self.transfers.discard(transfer)
+
+    def set_draining(self, queue):
+        """ Hedging starts once ``queue`` (the pool's pending tasks) is empty """
+        self.pending = queue
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def stop(self):
+        """ Ends the monitor thread once the run is over """
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+    def check(self):
+        now = time.time()
+        with self.lock:
+            transfers = list(self.transfers)
+        rates = {}
+        for transfer in transfers:
+            transfer.samples.append((now, transfer.bytes))
+            while len(transfer.samples) > 2 and now - transfer.samples[1][0] >= self.window:
+                transfer.samples.popleft()
+            rates[transfer] = transfer.rate(self.window)
+
+        median = None
+        if self.hedge and self.pending is not None and self.pending.empty():
+            known = sorted(r for r in rates.values() if r is not None)
+            if len(known) > 1:
+                median = known[len(known) // 2]
+
+        for transfer in transfers:
+            if transfer.stalled:
+                continue
+            rate = rates[transfer]
+            if transfer.first_byte is None:
+                if now - transfer.started > self.first_byte_timeout:
+                    self.abort(transfer, 'no data received within {}s'.format(self.first_byte_timeout))
+            elif now - transfer.last_byte > self.idle_timeout:
+                self.abort(transfer, 'no data received for {}s'.format(self.idle_timeout))
+            elif rate is not None and rate < self.min_rate:
+                self.abort(transfer, 'throughput {:.0f} B/s below {:.0f} B/s'.format(rate, self.min_rate))
+            elif median and rate is not None and rate < median * self.hedge_ratio \
+                    and transfer.name not in self.hedged:
+                self.hedged.add(transfer.name)
+                self.abort(transfer, 'throughput {:.0f} B/s far below the median of {:.0f} B/s, '
+                                     're-requesting'.format(rate, median))
+
+    def abort_all(self, reason):
+        with self.lock:
+            transfers = list(self.transfers)
+        for transfer in transfers:
+            self.abort(transfer, reason)
+
+    def abort(self, transfer, reason):
+        transfer.stalled = reason
+        self.log.info('Aborting stalled download {}: {}'.format(transfer.name, reason))
+        if transfer.response is None:
+            # Still waiting for headers, the request's read timeout takes care of it
+            return
+        try:
+            transfer.response.raw.connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+
+
+class WatchedStream:
+    """ Wraps response.raw so every read reports progress to the transfer's watchdog """
+
+    def __init__(self, raw, transfer):
+        self.raw = raw
+        self.transfer = transfer
+
+    def readinto(self, b):
+        try:
+            n = self.raw.readinto(b[:WATCH_READ_SIZE])
+        except Exception as e:
+            if self.transfer.stalled:
+                raise StalledTransfer(self.transfer.stalled) from e
+            raise
+        if self.transfer.stalled:
+            raise StalledTransfer(self.transfer.stalled)
+        self.transfer.update(n)
+        return n
@@ -0,0 +1,230 @@
+"""
+Multi-process execution for high-bandwidth nodes.
+
+With --processes N the download runs in N worker processes, each with its
+own thread pool, chunk buffers, connection handling and watchdog, so TLS
+decryption, hashing and chunk handling are spread over N interpreters
+instead of contending for one GIL. The coordinating process keeps doing the
+planning (manifests, /files lookups, presigning, directories, disk space
+admission) and hands every file with its presigned URL to the worker with
+the fewest files outstanding. With --bundle all files of a bundle go to the
+same worker, so no archive is ever appended to by two processes.
+
+Workers send a CompletionRecord back for every file, from which the
+coordinator merges progress and metrics. Workers ignore SIGINT; on Ctrl-C the
+coordinator cancels them through a shared event, they abort their transfers
+(keeping the .partial files) and exit. A worker that dies without saying
+goodbye (killed by the OOM killer or a signal) has its outstanding files
+reported as failed, and no more files are handed to it.
+"""
+
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import zlib
+
+from src.Bundle import bundle_key
+
+logger = logging.getLogger(__name__)
+
+# Seconds stop() waits for workers to exit before terminating them
+STOP_TIMEOUT = 30
+CANCEL_POLL_INTERVAL = 0.5
+# Seconds between checks that the workers are still alive while waiting for results
+LIVENESS_INTERVAL = 1
+
+
+class ResultQueue:
+    """ Stands in for a worker Downloader's completion queue, tagging every record with the worker """
+
+    def __init__(self, index, results):
+        self.index = index
+        self.results = results
+
+    def put(self, record):
+        self.results.put((self.index, record))
+
+
+def worker_main(index, args, tasks, results, cancelled):
+    """ Entry point of a worker process """
+    from src.Downloader import Downloader, ThreadPool
+    from src.Progress import NullProgress
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if getattr(args, 'profile', None):
+        root, ext = os.path.splitext(args.profile)
+        args.profile = '{}.worker{}{}'.format(root, index, ext)
+    downloader = Downloader(args, autostart=False, select=False)
+    downloader.completed = ResultQueue(index, results)
+    # Disk space is admitted and progress is tracked by the coordinator for all workers together
+    downloader.space = None
+    downloader.progress = NullProgress()
+
+    def watch_cancelled():
+        # Polled, a process waiting on a multiprocessing Event when it exits
+        # would block the coordinator's set() forever
+        while not cancelled.is_set():
+            time.sleep(CANCEL_POLL_INTERVAL)
+        downloader.cancel()
+        tasks.put(None)
+
+    threading.Thread(target=watch_cancelled, daemon=True).start()
+    pool = ThreadPool(downloader.thread_num)
+    downloader.monitor.set_draining(pool.tasks)
+    try:
+        while True:
+            batch = tasks.get()
+            if batch is None:
+                break
+            # The coordinator created the directories of the batch before handing it out
+            downloader.sink.directories_made([package_file.alias for package_file, _ in batch])
+            for package_file, url in batch:
+                downloader.files.put(package_file, url)
+                pool.add_task(downloader.download_from_url, package_file)
+        pool.wait_completion()
+    finally:
+        downloader.small_file_log.flush()
+        downloader.sink.close()
+        downloader.monitor.stop()
+        profile = downloader.profiler.close()
+        if profile:
+            logger.info('Worker {}\n{}'.format(index, profile))
+        results.put((index, None))
+
+
+class WorkerProcesses:
+    """ Coordinator side of a multi-process run """
+
+    def __init__(self, args, processes, report, location=None, log=logger):
+        """
+        :param args: argparse namespace of the run, passed on to every worker
+        :param processes: number of worker processes
+        :param report: called with every CompletionRecord and the PackageFile it belongs to
+        :param location: maps an alias to its output location, for the records of files lost with a worker
+        :param log: logger for workers that died or had to be terminated
+        """
+        self.location = location
+        self.log = log
+        # Workers are spawned rather than forked, the coordinator already runs threads
+        context = multiprocessing.get_context('spawn')
+        self.report = report
+        self.bundle = getattr(args, 'bundle', None)
+        self.cancelled = context.Event()
+        self.results = context.Queue()
+        self.queues = [context.Queue() for _ in range(processes)]
+        self.outstanding = [0] * processes
+        # Files handed out and not reported yet, by alias, with the worker they went to
+        self.pending = {}
+        # Workers that exited, or died, and receive no more files
+        self.exited = set()
+        self.lock = threading.Lock()
+        self.processes = [context.Process(target=worker_main, name='download-worker-{}'.format(i),
+                                          args=(i, args, self.queues[i], self.results, self.cancelled))
+                          for i in range(processes)]
+        for process in self.processes:
+            process.start()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def choose(self, package_file):
+        """ :return: index of the worker for ``package_file``, None if it would go to a worker that died """
+        if self.bundle:
+            key = bundle_key(package_file.alias, self.bundle)
+            index = zlib.crc32(key.encode()) % len(self.processes)
+            return None if index in self.exited else index
+        alive = [index for index in range(len(self.processes)) if index not in self.exited]
+        return min(alive, key=self.outstanding.__getitem__) if alive else None
+
+    def submit(self, files):
+        """ :param files: list of (PackageFile, presigned URL) """
+        batches = [[] for _ in self.processes]
+        lost = []
+        with self.lock:
+            for package_file, url in files:
+                index = self.choose(package_file)
+                if index is None:
+                    lost.append(package_file)
+                    continue
+                batches[index].append((package_file, url))
+                self.outstanding[index] += 1
+                self.pending[package_file.alias] = (index, package_file)
+        for index, batch in enumerate(batches):
+            if batch:
+                self.queues[index].put(batch)
+        for package_file in lost:
+            self.fail(package_file, 'its worker process died')
+
+    def fail(self, package_file, error):
+        from src.Downloader import CompletionRecord
+
+        location = self.location(package_file.alias) if self.location else None
+        self.report(CompletionRecord(package_file.alias, location, None, None, 'failed', error), package_file)
+
+    def collect(self):
+        checked = time.time()
+        while len(self.exited) < len(self.processes):
+            try:
+                self.received(*self.results.get(timeout=LIVENESS_INTERVAL))
+            except queue.Empty:
+                pass
+            if time.time() - checked >= LIVENESS_INTERVAL:
+                checked = time.time()
+                self.check_workers()
+
+    def received(self, index, record):
+        with self.lock:
+            if record is None:
+                self.exited.add(index)
+                return
+            self.outstanding[index] -= 1
+            _, package_file = self.pending.pop(record.alias, (None, None))
+        self.report(record, package_file)
+
+    def check_workers(self):
+        """ Fails the outstanding files of workers that died without sending their last record """
+        dead = [index for index, process in enumerate(self.processes)
+                if index not in self.exited and process.exitcode is not None]
+        if not dead:
+            return
+        # Whatever a worker sent before it exited is already in the pipe
+        try:
+            while True:
+                self.received(*self.results.get_nowait())
+        except queue.Empty:
+            pass
+        for index in dead:
+            if index in self.exited:
+                continue
+            with self.lock:
+                self.exited.add(index)
+                lost = [package_file for alias, (worker, package_file) in self.pending.items() if worker == index]
+                for package_file in lost:
+                    del self.pending[package_file.alias]
+                self.outstanding[index] = 0
+            # Batches the worker never read would keep this process from exiting
+            self.queues[index].cancel_join_thread()
+            self.log.error('{} exited with code {}, {} files it was downloading are reported as failed'.format(
+                self.processes[index].name, self.processes[index].exitcode, len(lost)))
+            for package_file in lost:
+                self.fail(package_file, 'worker process exited with code {}'.format(self.processes[index].exitcode))
+
+    def close(self):
+        """ Waits until every worker has handled its files and exited """
+        for tasks in self.queues:
+            tasks.put(None)
+        self.collector.join()
+        for process in self.processes:
+            process.join()
+
+    def stop(self):
+        """ Cancels all workers, terminating the ones that do not exit in time """
+        self.cancelled.set()
+        for process in self.processes:
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                self.log.info('Terminating {}'.format(process.name))
+                process.terminate()
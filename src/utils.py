@@ -13,10 +13,6 @@ import threading
 import time
 import traceback
 
-import boto3
-import requests
-from requests.adapters import HTTPAdapter
-
 IS_PY2 = sys.version_info < (3, 0)
 
 if IS_PY2:
@@ -170,18 +166,204 @@ def human_time(seconds):
     d, h = divmod(h, 24)
     return str(f'{d:d}:{h:02d}:{m:02d}:{s:02d}')
 
+class CircuitBreaker:
+    """
+    Shared by every thread talking to the same host. After ``failure_threshold``
+    consecutive server-side failures the breaker opens and every caller waits
+    out the cooldown instead of hammering a service that is down. The cooldown
+    doubles each time the breaker opens again, up to ``max_cooldown``.
+    """
+
+    def __init__(self, name, failure_threshold=5, cooldown=30, max_cooldown=600):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.failures = 0
+        self.open_until = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                remaining = self.open_until - time.time()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 5))
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            if self.open_until < time.time():
+                self.cooldown = self.base_cooldown
+
+    def record_failure(self, retry_after=None):
+        with self.lock:
+            self.failures += 1
+            if self.failures < self.failure_threshold or self.open_until > time.time():
+                return
+            pause = max(self.cooldown, retry_after or 0)
+            self.open_until = time.time() + pause
+            self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            self.failures = 0
+        logger.warning('{} appears to be unavailable, pausing all requests for {}s'.format(self.name, int(pause)))
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+def get_circuit_breaker(url):
+    """ Returns the circuit breaker shared by all requests to the host of ``url`` """
+    host = urlparse(url).hostname or url
+    with _circuit_breakers_lock:
+        if host not in _circuit_breakers:
+            _circuit_breakers[host] = CircuitBreaker(host)
+        return _circuit_breakers[host]
+
+
+class RetryPolicy:
+    """
+    The single retry layer used for NDA API requests and S3 downloads.
+
+    Failures are classified as
+      - throttled (429): retried after Retry-After or the backoff delay
+      - server errors (5xx), timeouts and connection errors: retried with
+        exponential backoff and full jitter. Server errors, timeouts and
+        failures to connect are counted by the host's circuit breaker, transfers
+        that broke off or were aborted by the watchdog are only retried
+      - client errors (other 4xx) and anything else: not retried
+    Each call gives up after ``max_attempts`` attempts or once it would have
+    spent more than ``budget`` seconds waiting between attempts, whichever
+    comes first. Time spent in the attempts themselves (e.g. a long transfer
+    that fails near the end) does not count against the budget.
+    """
+
+    RETRY = 'retry'
+    THROTTLED = 'throttled'
+    FAIL = 'fail'
+
+    RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+    def __init__(self, max_attempts=8, base_delay=1, max_delay=120, budget=900):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+
+    @staticmethod
+    def retryable_exceptions():
+        import socket
+        import requests
+        import urllib3
+        return (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError, urllib3.exceptions.HTTPError,
+                socket.timeout, ConnectionError)
+
+    @staticmethod
+    def host_failure_exceptions():
+        """ Errors meaning the host is unreachable or overloaded, as opposed to one transfer that went wrong """
+        import socket
+        import requests
+        import urllib3
+        return (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                urllib3.exceptions.NewConnectionError, urllib3.exceptions.TimeoutError, socket.timeout)
+
+    def is_host_failure(self, response=None, exception=None):
+        """ Whether a retried failure counts against the host's circuit breaker """
+        if response is not None:
+            return response.status_code >= 500
+        return isinstance(exception, self.host_failure_exceptions())
+
+    def classify(self, response=None, exception=None):
+        if response is not None:
+            if response.ok:
+                return None
+            if response.status_code == 429:
+                return self.THROTTLED
+            if response.status_code in self.RETRY_STATUS_CODES:
+                return self.RETRY
+            return self.FAIL
+        if isinstance(exception, self.retryable_exceptions()):
+            return self.RETRY
+        return self.FAIL
+
+    @staticmethod
+    def retry_after(response):
+        """ Seconds requested by a Retry-After header, or None """
+        if response is None:
+            return None
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+        try:
+            from email.utils import parsedate_to_datetime
+            return max(0, (parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+    def delay(self, attempt, response=None):
+        retry_after = self.retry_after(response)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, url, func, *args, **kwargs):
+        """
+        Calls ``func(*args, **kwargs)`` until it succeeds or the retry budget is spent.
+        ``func`` may either return a requests.Response (non-ok responses are
+        classified by status code) or raise; the last response is returned or
+        the last exception re-raised when giving up.
+        :param url: URL being requested, selects the circuit breaker and is used for logging
+        """
+        import requests
+
+        breaker = get_circuit_breaker(url)
+        waited = 0
+        attempt = 0
+        while True:
+            breaker.wait()
+            response, error = None, None
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                error = e
+                response = getattr(e, 'response', None)
+                kind = self.classify(response=response, exception=e)
+            else:
+                if not isinstance(result, requests.Response):
+                    breaker.record_success()
+                    return result
+                response = result
+                kind = self.classify(response=response)
+                if kind is None:
+                    breaker.record_success()
+                    return result
+            attempt += 1
+            wait = self.delay(attempt, response)
+            if kind == self.FAIL or attempt >= self.max_attempts or waited + wait > self.budget:
+                if error is not None:
+                    raise error
+                return response
+            if kind == self.RETRY and self.is_host_failure(response, error):
+                breaker.record_failure(self.retry_after(response))
+            logger.debug('Attempt {} of {} failed for {} ({}), retrying in {:.1f}s'.format(
+                attempt, self.max_attempts, url.split('?')[0],
+                error if error is not None else response.status_code, wait))
+            time.sleep(wait)
+            waited += wait
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
 def retry_connection_errors(func):
     @functools.wraps(func)
-    def _retry(*args, **kwargs):
-        tmp = None
-        for i in range(10):
-            try:
-                tmp = func(*args, **kwargs)
-                return tmp
-            except requests.exceptions.ConnectionError as e:
-                if i == 9:
-                    raise e
-                time.sleep(random.randint(10, 30))
+    def _retry(prepped, *args, **kwargs):
+        return DEFAULT_RETRY_POLICY.call(prepped.url, func, prepped, *args, **kwargs)
     return _retry
 
 def is_json(test):
@@ -193,44 +375,37 @@ def is_json(test):
 
 @retry_connection_errors
 def _send_prepared_request(prepped, timeout=150, deserialize_handler=DeserializeHandler.convert_json, error_handler=HttpErrorHandlingStrategy.print_and_exit):
+    import requests
+
     with requests.Session() as session:
         logger.debug('{} {} @ {}'.format(prepped.method , prepped.url, datetime.datetime.now()))
-        session.mount(prepped.url, HTTPAdapter(max_retries=10))
         tmp = session.send(prepped, timeout=timeout)
         logger.debug('{} {} (elapsed = {})- STATUS {}'.format(prepped.method, prepped.url, tmp.elapsed, tmp.status_code))
         if not tmp.ok:
             error_handler(tmp)
     return deserialize_handler(tmp)
 
-def get_request(url, headers=None, auth=None, _json=None, error_handler=HttpErrorHandlingStrategy.print_and_exit):
-    tmp = None
-    for i in range(10):
-        try:
-            with requests.Session() as session:
-                session.mount(url, HTTPAdapter(max_retries=10))
-                tmp = session.get(url, headers=headers, auth=auth, json=_json)
-                if not tmp.ok:
-                    error_handler(tmp)
-            return tmp
-        except requests.exceptions.ConnectionError as e:
-            if i == 9:
-                raise e
-            time.sleep(random.randint(10, 30))
-
-def post_request(url, _json, headers=None, auth=None, error_handler=HttpErrorHandlingStrategy.print_and_exit):
-    tmp = None
-    for i in range(10):
-        try:
-            with requests.Session() as session:
-                session.mount(url, HTTPAdapter(max_retries=10))
-                tmp = session.post(url, json=_json, headers=headers, auth=auth)
-                if not tmp.ok:
-                    error_handler(tmp)
-            return tmp
-        except requests.exceptions.ConnectionError as e:
-            if i == 9:
-                raise e
-            time.sleep(random.randint(10, 30))
+def get_request(url, headers=None, auth=None, _json=None, error_handler=HttpErrorHandlingStrategy.print_and_exit,
+                retry_policy=None, timeout=150):
+    import requests
+
+    retry_policy = retry_policy or DEFAULT_RETRY_POLICY
+    with requests.Session() as session:
+        tmp = retry_policy.call(url, session.get, url, headers=headers, auth=auth, json=_json, timeout=timeout)
+        if not tmp.ok:
+            error_handler(tmp)
+    return tmp
+
+def post_request(url, _json, headers=None, auth=None, error_handler=HttpErrorHandlingStrategy.print_and_exit,
+                 retry_policy=None, timeout=150):
+    import requests
+
+    retry_policy = retry_policy or DEFAULT_RETRY_POLICY
+    with requests.Session() as session:
+        tmp = retry_policy.call(url, session.post, url, json=_json, headers=headers, auth=auth, timeout=timeout)
+        if not tmp.ok:
+            error_handler(tmp)
+    return tmp
 
 def get_data_and_header_params(payload, headers):
     data_param = {}